@@ -0,0 +1,114 @@
+""" Create the mediator indexes and check that no find, distinct or aggregate in db_utils does a collection scan
+
+    python check_indexes.py          create the indexes and check the query plans
+    python check_indexes.py --check  only check the query plans
+"""
+import asyncio
+import sys
+from bson.objectid import ObjectId
+from db_utils import db, create_indexes
+
+# (collection, filter, sort) with the shape of each query in db_utils,
+# the one-shot migrations are run once per database and are not listed
+QUERIES = [
+    ("connections", {"remote_did": "did:peer:2"}, None),
+    ("connections", {"isMediation": True}, {"_id": -1}),
+    ("migrations", {"_id": "keylists"}, None),
+    ("oobs", {}, {"date": -1}),
+    ("issuers", {"did": {"$regex": "^did:key"}}, {"date": -1}),
+    ("keys", {"connection_id": ObjectId(), "recipient_did": {"$in": ["did:peer:2"]}}, None),
+    ("keys", {"connection_id": ObjectId(), "recipient_did": "did:peer:2"}, None),
+    ("keys", {"connection_id": ObjectId()}, {"recipient_did": 1}),
+    ("keys", {"connection_id": ObjectId(), "recipient_did": {"$gt": "did:peer:2"}}, {"recipient_did": 1}),
+    ("connections", {"_id": ObjectId()}, None),
+    ("migrations", {"_id": "key_counts"}, None),
+    ("keys", {"recipient_did": "did:peer:2"}, None),
+    ("messages", {"recipient_key": "did:peer:2"}, {"received_time": 1}),
+    ("messages", {"recipient_key": {"$in": ["did:peer:2", "did:peer:2b"]}}, None),
+    ("messages", {"recipient_key": {"$in": ["did:peer:2", "did:peer:2b"]}, "datetime": {"$lte": 0}, "lease_until": {"$not": {"$gt": 0}}, "expires_time": {"$not": {"$lte": 0}}}, {"datetime": 1, "_id": 1}),
+    ("messages", {"expires_time": {"$lte": 0}}, {"expires_time": 1}),
+    ("messages", {"_id": {"$in": [ObjectId()]}}, None),
+    ("keys", {"recipient_did": {"$in": ["did:peer:2"]}}, {"_id": 1}),
+    ("queues", {"connection_id": ObjectId()}, None),
+    ("queues", {"_id": {"$in": ["did:peer:2"]}}, None),
+    ("migrations", {"_id": "queue_stats"}, None),
+    ("secrets", {"kid": "did:peer:2#key-1"}, None),
+    ("secrets", {"kid": {"$in": ["did:peer:2#key-1"]}}, None),
+    ("shortUrls", {"oobid": "0"}, {"date": -1}),
+    ("outbound", {"status": "pending", "next_attempt": {"$lte": 0}}, {"next_attempt": 1}),
+]
+
+# distinct and aggregate commands with the shape of the other queries in db_utils,
+# rebuild_queue_stats is listed for a list of keys, without keys it is only run by a migration
+COMMANDS = [
+    {"distinct": "keys", "key": "recipient_did", "query": {"connection_id": ObjectId()}},
+    {"distinct": "keys", "key": "recipient_did", "query": {"connection_id": ObjectId(), "recipient_did": {"$in": ["did:peer:2"]}}},
+    {"aggregate": "messages", "cursor": {}, "pipeline": [
+        {"$match": {"recipient_key": {"$in": ["did:peer:2", "did:peer:2b"]}}},
+        {"$group": {"_id": "$recipient_key", "count": {"$sum": 1}}}
+    ]},
+    {"aggregate": "queues", "cursor": {}, "pipeline": [
+        {"$match": {"connection_id": {"$in": [ObjectId()]}}},
+        {"$group": {"_id": "$connection_id", "count": {"$sum": "$count"}}}
+    ]},
+    {"aggregate": "queues", "cursor": {}, "pipeline": [
+        {"$match": {"connection_id": {"$in": [ObjectId()]}, "count": {"$gt": 0}}},
+        {"$group": {"_id": "$connection_id", "oldest_received_time": {"$min": "$oldest_received_time"}}}
+    ]},
+    {"aggregate": "queues", "cursor": {}, "pipeline": [
+        {"$match": {"_id": {"$in": ["did:peer:2"]}, "move": ObjectId()}},
+        {"$group": {"_id": {"source": "$moved_from", "target": "$connection_id"}, "count": {"$sum": "$moved_count"}}}
+    ]},
+]
+
+
+def plan_stages(plan):
+    """ All stage names of a query plan """
+    if "queryPlan" in plan:
+        plan = plan["queryPlan"]
+    stages = [plan["stage"]]
+    for child in plan.get("inputStages", []) + ([plan["inputStage"]] if "inputStage" in plan else []):
+        stages += plan_stages(child)
+    return stages
+
+
+def winning_plans(explain):
+    """ The winning plans found anywhere in an explain output, aggregates nest them in their stages """
+    if isinstance(explain, dict):
+        if "winningPlan" in explain:
+            return [explain["winningPlan"]]
+        return [plan for value in explain.values() for plan in winning_plans(value)]
+    if isinstance(explain, list):
+        return [plan for value in explain for plan in winning_plans(value)]
+    return []
+
+
+async def check_query_plans():
+    """ Explain every query, return the ones planned as a collection scan """
+    commands = []
+    for collection, filter, sort in QUERIES:
+        command = {"find": collection, "filter": filter}
+        if sort:
+            command["sort"] = sort
+        commands.append(command)
+    scans = []
+    for command in commands + COMMANDS:
+        explain = await db.command({"explain": command, "verbosity": "queryPlanner"})
+        stages = [stage for plan in winning_plans(explain) for stage in plan_stages(plan)]
+        print(command, "->", " <- ".join(stages))
+        if "COLLSCAN" in stages:
+            scans.append(command)
+    return scans
+
+
+async def main():
+    if "--check" not in sys.argv:
+        await create_indexes()
+    scans = await check_query_plans()
+    for command in scans:
+        print("ERROR: collection scan on", command)
+    return 1 if scans else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
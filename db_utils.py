@@ -1,62 +1,152 @@
 ''' DB Utilities '''
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import ReturnDocument, UpdateOne, DeleteOne, WriteConcern
+from pymongo.errors import BulkWriteError, WriteError
 from bson.objectid import ObjectId
+from bson.binary import Binary
+from collections import OrderedDict
+import asyncio
 import datetime
+import json
 import os
+import time
 import urllib.parse
+import uuid
+import zlib
 
+DB_MAX_POOL_SIZE = int(os.environ["DB_MAX_POOL_SIZE"]) if "DB_MAX_POOL_SIZE" in os.environ else 100
+DB_MIN_POOL_SIZE = int(os.environ["DB_MIN_POOL_SIZE"]) if "DB_MIN_POOL_SIZE" in os.environ else 0
+CONNECTION_CACHE_SIZE = int(os.environ["CONNECTION_CACHE_SIZE"]) if "CONNECTION_CACHE_SIZE" in os.environ else 10000
+# other workers don't invalidate this cache, entries are read again after CONNECTION_CACHE_SECONDS
+CONNECTION_CACHE_SECONDS = float(os.environ["CONNECTION_CACHE_SECONDS"]) if "CONNECTION_CACHE_SECONDS" in os.environ else 60.0
+# write concern acknowledging stored messages, e.g. "majority" or "1", default is the client one
+MESSAGE_WRITE_CONCERN = os.environ["MESSAGE_WRITE_CONCERN"] if "MESSAGE_WRITE_CONCERN" in os.environ else None
+MESSAGE_JOURNAL = os.environ["MESSAGE_JOURNAL"] == "1" if "MESSAGE_JOURNAL" in os.environ else False
+# "zlib" stores forwarded payloads as compressed bytes, "none" as BSON documents
+MESSAGE_CODEC = os.environ["MESSAGE_CODEC"] if "MESSAGE_CODEC" in os.environ else "none"
+# payloads bigger than MESSAGE_BLOB_THRESHOLD bytes are kept out of db.messages, 0 disables it
+MESSAGE_BLOB_THRESHOLD = int(os.environ["MESSAGE_BLOB_THRESHOLD"]) if "MESSAGE_BLOB_THRESHOLD" in os.environ else 0
+# "gridfs" or "filesystem", the latter writes the payloads to MESSAGE_BLOB_PATH
+MESSAGE_BLOB_STORE = os.environ["MESSAGE_BLOB_STORE"] if "MESSAGE_BLOB_STORE" in os.environ else "gridfs"
+MESSAGE_BLOB_PATH = os.environ["MESSAGE_BLOB_PATH"] if "MESSAGE_BLOB_PATH" in os.environ else "blobs"
+# seconds a queued message is kept when the forward has no expires_time, 0 keeps it until picked up
+MESSAGE_TTL_SECONDS = int(os.environ["MESSAGE_TTL_SECONDS"]) if "MESSAGE_TTL_SECONDS" in os.environ else 0
+# seconds a delivered message stays hidden from other pickups while waiting for messages-received, 0 disables leases
+MESSAGE_LEASE_SECONDS = int(os.environ["MESSAGE_LEASE_SECONDS"]) if "MESSAGE_LEASE_SECONDS" in os.environ else 30
+# fields the queue statistics need from deleted messages
+QUEUE_FIELDS = {"recipient_key": 1, "size": 1, "blob": 1, "received_time": 1, "datetime": 1}
+MESSAGE_FIELDS = {"attachment": 1, "payload": 1, "codec": 1, "size": 1, "blob": 1, "expires_time": 1}
 
-mongo = MongoClient(
+mongo = AsyncIOMotorClient(
     os.environ["DB_URL"],
     username=urllib.parse.quote_plus(os.environ["MONGODB_USER"]) if "MONGODB_USER" in os.environ else None,
     password=urllib.parse.quote_plus(os.environ["MONGODB_PASSWORD"]) if "MONGODB_PASSWORD" in os.environ else None,
-    authSource="admin"
+    authSource="admin",
+    maxPoolSize=DB_MAX_POOL_SIZE,
+    minPoolSize=DB_MIN_POOL_SIZE
 )
 
 
 db = mongo.mediator
+blobs = None
 
-def get_connection(remote_did):
+def get_blobs():
+    ''' GridFS bucket of offloaded message payloads '''
+    global blobs
+    if not blobs:
+        blobs = AsyncIOMotorGridFSBucket(db, bucket_name="blobs")
+    return blobs
+message_writes = db.messages.with_options(write_concern=WriteConcern(
+    w=int(MESSAGE_WRITE_CONCERN) if MESSAGE_WRITE_CONCERN and MESSAGE_WRITE_CONCERN.isdigit() else MESSAGE_WRITE_CONCERN,
+    j=True if MESSAGE_JOURNAL else None
+)) if MESSAGE_WRITE_CONCERN or MESSAGE_JOURNAL else db.messages
+
+class Connection:
+    ''' Cached connection record, the keylist is not cached as other workers may update it '''
+    __slots__ = ("id", "remote_did", "local_did", "routing_did", "is_mediation", "endpoint", "expires")
+
+    def __init__(self, document):
+        self.id = document["_id"]
+        self.remote_did = document["remote_did"]
+        self.local_did = document["local_did"]
+        self.routing_did = document.get("routing_did")
+        self.is_mediation = document.get("isMediation", False)
+        self.endpoint = document.get("endpoint")
+        self.expires = time.monotonic() + CONNECTION_CACHE_SECONDS
+
+connections = OrderedDict()
+
+def cache_connection(connection):
+    if CONNECTION_CACHE_SIZE <= 0:
+        return
+    connections[connection.remote_did] = connection
+    connections.move_to_end(connection.remote_did)
+    if len(connections) > CONNECTION_CACHE_SIZE:
+        connections.popitem(last=False)
+
+def invalidate_connection(remote_did):
+    connections.pop(remote_did, None)
+
+async def get_connection(remote_did):
     ''' Get existing connection '''
-    return db.connections.find_one({"remote_did": remote_did})
+    connection = connections.get(remote_did)
+    if connection and connection.expires > time.monotonic():
+        connections.move_to_end(remote_did)
+        return connection
+    document = await db.connections.find_one({"remote_did": remote_did})
+    if not document:
+        invalidate_connection(remote_did)
+        return None
+    connection = Connection(document)
+    cache_connection(connection)
+    return connection
 
-def create_connection(remote_did, local_did):
+async def create_connection(remote_did, local_did):
     ''' Create connection'''
-    db.connections.insert_one({
+    document = {
         "remote_did": remote_did,
         "local_did": local_did,
         "creation_time": int(datetime.datetime.now().timestamp())
-    })
+    }
+    await db.connections.insert_one(document)
+    cache_connection(Connection(document))
 
-def update_connection(remote_old_did, remote_new_did):
+async def update_connection(remote_old_did, remote_new_did):
     ''' Update connection '''
     #TODO history of rotations
-    db.connections.update_one(
+    await db.connections.update_one(
         {"remote_did": remote_old_did}, {
             "$set": {"remote_did": remote_new_did, "update_time": int(datetime.datetime.now().timestamp())}
         }
     )
+    invalidate_connection(remote_old_did)
+    invalidate_connection(remote_new_did)
+
+async def get_routing_dids(limit):
+    ''' Get the routing DIDs of the most recent mediations '''
+    cursor = db.connections.find({"isMediation": True}, {"routing_did": 1}).sort("_id", -1).limit(limit)
+    return [c["routing_did"] async for c in cursor if c.get("routing_did")]
 
-def get_oob_did():
-    return db.oobs.find_one(sort=[('date', -1)])
+async def get_oob_did():
+    return await db.oobs.find_one(sort=[('date', -1)])
 
-def store_oob_did(did):
-    db.oobs.insert_one(did)
+async def store_oob_did(did):
+    await db.oobs.insert_one(did)
 
-def del_issuers():
-    db.messaissuersges.delete_many({})
+async def del_issuers():
+    await db.messaissuersges.delete_many({})
     
-def get_demo_issuer_did():
+async def get_demo_issuer_did():
     #get the issuer whose did fields starts with "did:peer"
     
-    issuer_did= db.issuers.find_one({"did": {"$regex": "^did:key"}},sort=[('date', -1)])
+    issuer_did= await db.issuers.find_one({"did": {"$regex": "^did:key"}},sort=[('date', -1)])
     # issuer_did = db.issuers.find_one(sort=[('date', -1)])
     return issuer_did
 
 
-def add_mediation(remote_did, routing_did, endpoint):
+async def add_mediation(remote_did, routing_did, endpoint):
     ''' Add mediation info to connection '''
-    db.connections.update_one(
+    await db.connections.update_one(
         {"remote_did": remote_did}, {
             "$set": {
                         "isMediation": True, 
@@ -65,120 +155,615 @@ def add_mediation(remote_did, routing_did, endpoint):
                     }
         }
     )
+    invalidate_connection(remote_did)
 
-def update_keys(remote_did, updates):
-    ''' Add mediation keys '''
-    connection = get_connection(remote_did)
-    current_keys = connection["keylist"] if "keylist" in connection else []
+async def update_keys(remote_did, updates):
+    ''' Add or remove mediation keys with a single bulk write '''
+    connection = await get_connection(remote_did)
+    recipient_dids = [update["recipient_did"] for update in updates]
+    existing = set(await db.keys.distinct(
+        "recipient_did", {"connection_id": connection.id, "recipient_did": {"$in": recipient_dids}}
+    ))
+    current_keys = set(existing)
     updated = []
     for update in updates:
+        recipient_did = update["recipient_did"]
         if update["action"] == "add":
-            if update["recipient_did"] in current_keys:
-                updated.append(
-                    {
-                        "recipient_did": update["recipient_did"],
-                        "action": "add",
-                        "result": "no_change"
-                    })
-            else:
-                current_keys.append(update["recipient_did"])
-                updated.append(
-                    {
-                        "recipient_did": update["recipient_did"],
-                        "action": "add",
-                        "result": "success"
-                    })
+            result = "no_change" if recipient_did in current_keys else "success"
+            current_keys.add(recipient_did)
         elif update["action"] == "remove":
-            if update["recipient_did"] in current_keys:
-                current_keys.remove(update["recipient_did"])
-                updated.append(
-                    {
-                        "recipient_did": update["recipient_did"],
-                        "action": "remove",
-                        "result": "success"
-                    })
-            else:
-                updated.append(
-                    {
-                        "recipient_did": update["recipient_did"],
-                        "action": "remove",
-                        "result": "no_change"
-                    })
+            result = "success" if recipient_did in current_keys else "no_change"
+            current_keys.discard(recipient_did)
         else:
-            updated.append(
-                    {
-                        "recipient_did": update["recipient_did"],
-                        "action": update["action"],
-                        "result": "client_error"
-                    })
-        db.connections.update_one(
-        {"remote_did": remote_did}, {
-            "$set": {
-                        "keylist": current_keys, 
-                    }
-        }
-    )
+            result = "client_error"
+        updated.append(
+            {
+                "recipient_did": recipient_did,
+                "action": update["action"],
+                "result": result
+            })
+
+    operations = [
+        UpdateOne(
+            {"connection_id": connection.id, "recipient_did": recipient_did},
+            {"$setOnInsert": {"creation_time": int(datetime.datetime.now().timestamp())}},
+            upsert=True
+        )
+        for recipient_did in current_keys - existing
+    ] + [
+        DeleteOne({"connection_id": connection.id, "recipient_did": recipient_did})
+        for recipient_did in existing - current_keys
+    ]
+    if operations:
+        result = await db.keys.bulk_write(operations, ordered=False)
+        # keylist-query reports the remaining keys from this counter instead of counting them
+        await db.connections.update_one(
+            {"_id": connection.id}, {"$inc": {"key_count": result.upserted_count - result.deleted_count}}
+        )
+    # the connection counters follow the queues of the keys it owns
+    await move_queues(connection.id, current_keys - existing, existing - current_keys)
     return updated
 
-def get_message_status(remote_did, recipient_key):
-    resp = db.connections.find_one({"remote_did":remote_did})
-    if "keylist" in resp :
-        if recipient_key:
-            if recipient_key in resp["keylist"]:
-                recipient_keys = [recipient_key]
-            else:
-                recipient_keys = []
-        else:
-            recipient_keys = resp["keylist"]
-        count = db.messages.count_documents({"recipient_key": {"$in":recipient_keys}})
+async def get_keylist(remote_did, offset, limit, after=None):
+    ''' Page of recipient keys of a connection, ordered by key, and the total number of keys.
+        The page starts after the key after if given, else skips offset keys '''
+    connection = await get_connection(remote_did)
+    if after is not None:
+        keys = db.keys.find({"connection_id": connection.id, "recipient_did": {"$gt": after}}, {"_id": 0, "recipient_did": 1})
     else:
-        count = 0
+        keys = db.keys.find({"connection_id": connection.id}, {"_id": 0, "recipient_did": 1}).skip(offset)
+    keys = keys.sort("recipient_did", 1).limit(limit)
+    keylist = [k["recipient_did"] async for k in keys]
+    document = await db.connections.find_one({"_id": connection.id}, {"key_count": 1})
+    return keylist, document.get("key_count", 0) if document else 0
+
+async def get_recipient_keys(remote_did, recipient_key):
+    ''' Connection keys to look messages for, only recipient_key if given and owned by the connection '''
+    connection = await get_connection(remote_did)
+    if recipient_key:
+        key = await db.keys.find_one({"connection_id": connection.id, "recipient_did": recipient_key}, {"_id": 1})
+        return [recipient_key] if key else []
+    return await db.keys.distinct("recipient_did", {"connection_id": connection.id})
+
+# (collection, keys, options) of every index needed by the queries in this module
+INDEXES = [
+    ("connections", [("remote_did", 1)], {}),
+    ("connections", [("routing_did", 1)], {"sparse": True}),
+    ("connections", [("isMediation", 1), ("_id", -1)], {}),
+    ("keys", [("connection_id", 1), ("recipient_did", 1)], {"unique": True}),
+    ("keys", [("recipient_did", 1)], {}),
+    ("messages", [("recipient_key", 1), ("datetime", 1), ("_id", 1)], {}),
+    ("messages", [("expires_time", 1)], {"sparse": True}),
+    ("messages", [("recipient_key", 1), ("received_time", 1)], {}),
+    ("secrets", [("kid", 1)], {}),
+    ("oobs", [("date", -1)], {}),
+    ("issuers", [("did", 1), ("date", -1)], {}),
+    ("shortUrls", [("oobid", 1), ("date", -1)], {}),
+    ("outbound", [("status", 1), ("next_attempt", 1)], {}),
+    ("queues", [("connection_id", 1)], {}),
+]
+
+async def create_indexes():
+    ''' Create the indexes needed by the mediator queries. Existing indexes are left as they are '''
+    for collection, keys, options in INDEXES:
+        await db[collection].create_index(keys, **options)
 
-    return count
+async def migrate_keylists():
+    ''' Move keylist arrays embedded in connections to the keys collection, once per database '''
+    if await db.migrations.find_one({"_id": "keylists"}):
+        return
+    async for connection in db.connections.find({"keylist": {"$exists": True}}, {"keylist": 1}):
+        if connection["keylist"]:
+            await db.keys.bulk_write([
+                UpdateOne(
+                    {"connection_id": connection["_id"], "recipient_did": recipient_did},
+                    {"$setOnInsert": {"creation_time": int(datetime.datetime.now().timestamp())}},
+                    upsert=True
+                )
+                for recipient_did in connection["keylist"]
+            ], ordered=False)
+        await db.connections.update_one({"_id": connection["_id"]}, {"$unset": {"keylist": ""}})
+    await db.migrations.update_one({"_id": "keylists"}, {"$set": {"time": epoch_seconds()}}, upsert=True)
 
-def get_messages(remote_did, recipient_key,limit):
+async def migrate_key_counts():
+    ''' Count the keys of the connections registered before key_count existed, once per database '''
+    if await db.migrations.find_one({"_id": "key_counts"}):
+        return
+    counts = db.keys.aggregate([{"$group": {"_id": "$connection_id", "key_count": {"$sum": 1}}}])
+    operations = [UpdateOne({"_id": count["_id"]}, {"$set": {"key_count": count["key_count"]}}) async for count in counts]
+    if operations:
+        await db.connections.bulk_write(operations, ordered=False)
+    await db.migrations.update_one({"_id": "key_counts"}, {"$set": {"time": epoch_seconds()}}, upsert=True)
+
+async def get_message_status(remote_did, recipient_key):
+    ''' Queue statistics of recipient_key if owned by the connection, else of all the connection keys.
+        The counters include delayed messages and messages leased to an in-flight delivery '''
+    empty = {"count": 0, "bytes": 0}
+    connection = await get_connection(remote_did)
+    if not connection:
+        return empty
     if recipient_key:
-        # FIX validate that recipient_key belongs to remote_did
-        return list(db.messages.find({"recipient_key": recipient_key},{"attachment":1}).limit(limit))
+        if not await get_recipient_keys(remote_did, recipient_key):
+            return empty
+        queues, queue_id = db.queues, recipient_key
+    else:
+        queues, queue_id = db.connection_queues, connection.id
+    stats = await queues.find_one({"_id": queue_id}) or empty
+    if stats["count"] < 0 or stats["bytes"] < 0:
+        # the counters drifted, count the messages again
+        await rebuild_queue_stats(await get_recipient_keys(remote_did, recipient_key))
+        stats = await queues.find_one({"_id": queue_id}) or empty
+    return stats
+
+def epoch_seconds():
+    return int(datetime.datetime.now().timestamp())
+
+def visible_filter(current_time):
+    ''' Condition of the messages that are due, not expired and not leased by a pickup '''
+    return {
+        "datetime": {"$lte": current_time},
+        "lease_until": {"$not": {"$gt": current_time}},
+        # expired but not swept yet
+        "expires_time": {"$not": {"$lte": current_time}}
+    }
+
+async def claim_next_messages(remote_did, recipient_key, limit, max_bytes, lease_seconds=MESSAGE_LEASE_SECONDS, fields=MESSAGE_FIELDS):
+    ''' Lease the next visible messages of the connection keys in arrival order, up to limit messages
+        and max_bytes (at least one message). Messages taken by a concurrent pickup are replaced by the next ones '''
+    recipient_keys = await get_recipient_keys(remote_did, recipient_key)
+    claimed = []
+    total_bytes = 0
+    while recipient_keys and len(claimed) < limit:
+        current_time = epoch_seconds()
+        candidates = await db.messages.find(
+            {"recipient_key": {"$in":recipient_keys}, **visible_filter(current_time)}, {"size": 1}
+        ).sort([("datetime", 1), ("_id", 1)]).limit(limit - len(claimed)).to_list(None)
+        sizes = {}
+        full = False
+        for message in candidates:
+            size = message.get("size", 0)
+            if (claimed or sizes) and total_bytes + size > max_bytes:
+                full = True
+                break
+            total_bytes += size
+            sizes[message["_id"]] = size
+        if not sizes:
+            break
+        messages = await claim_messages(list(sizes), lease_seconds, fields)
+        claimed += messages
+        if full or len(messages) == len(sizes):
+            break
+        total_bytes -= sum(sizes.values()) - sum(sizes[message["_id"]] for message in messages)
+    return claimed
+
+def message_document(recipient_key, attachment, due_time=None, expires_time=None):
+    ''' Queued message, hidden from pickup until due_time and removed at expires_time (epoch seconds) '''
+    raw = json.dumps(attachment)
+    current_time = epoch_seconds()
+    document = {
+        "recipient_key": recipient_key,
+        "size": len(raw),
+        "datetime": max(current_time, due_time or 0),
+        "received_time": current_time
+    }
+    if MESSAGE_TTL_SECONDS > 0:
+        expires_time = min(expires_time or current_time + MESSAGE_TTL_SECONDS, current_time + MESSAGE_TTL_SECONDS)
+    if expires_time:
+        document["expires_time"] = expires_time
+    if MESSAGE_CODEC == "zlib":
+        document["payload"] = Binary(zlib.compress(raw.encode()))
+        document["codec"] = "zlib"
     else:
-        connection = db.connections.find_one({"remote_did":remote_did})
-        if "keylist" in connection:
-            recipient_keys = connection["keylist"]
-            return list(db.messages.find({"recipient_key": {"$in":recipient_keys}}).limit(limit))
+        document["attachment"] = attachment
+    return document
+
+def message_attachment(message):
+    ''' Attachment of a stored message, whatever codec it was stored with '''
+    if "payload" in message:
+        return json.loads(zlib.decompress(message["payload"]) if message.get("codec") == "zlib" else message["payload"])
+    return message["attachment"]
+
+async def load_attachment(message):
+    ''' Attachment of a stored message, read from the blob store if it was offloaded '''
+    if "blob" in message:
+        message = dict(message, payload=await read_blob(message["blob"]))
+    return message_attachment(message)
+
+def _write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+async def offload_payload(document):
+    ''' Move the payload of a big message document to the blob store, keeping a reference '''
+    if "payload" in document:
+        data = bytes(document.pop("payload"))
+    else:
+        data = json.dumps(document.pop("attachment")).encode()
+        document["codec"] = "none"
+    if MESSAGE_BLOB_STORE == "filesystem":
+        name = uuid.uuid4().hex
+        await asyncio.get_running_loop().run_in_executor(
+            None, _write_file, os.path.join(MESSAGE_BLOB_PATH, name[:2], name), data)
+        document["blob"] = {"store": "filesystem", "id": name}
+    else:
+        document["blob"] = {"store": "gridfs", "id": await get_blobs().upload_from_stream(document["recipient_key"], data)}
+
+async def read_blob(blob):
+    if blob["store"] == "filesystem":
+        return await asyncio.get_running_loop().run_in_executor(
+            None, _read_file, os.path.join(MESSAGE_BLOB_PATH, blob["id"][:2], blob["id"]))
+    stream = await get_blobs().open_download_stream(blob["id"])
+    return await stream.read()
+
+async def remove_blob(blob):
+    try:
+        if blob["store"] == "filesystem":
+            await asyncio.get_running_loop().run_in_executor(
+                None, os.remove, os.path.join(MESSAGE_BLOB_PATH, blob["id"][:2], blob["id"]))
         else:
-            return []
-        
+            await get_blobs().delete(blob["id"])
+    except Exception as ex:
+        print("ERROR: Removing message blob failed", blob, ex)
 
-def add_message(recipient_key, attachment):
+async def offload_payloads(documents):
+    if MESSAGE_BLOB_THRESHOLD > 0:
+        await asyncio.gather(*[
+            offload_payload(document) for document in documents if document["size"] > MESSAGE_BLOB_THRESHOLD
+        ])
+
+async def add_message(recipient_key, attachment, due_time=None, expires_time=None):
     # TODO verify that recipient_key belong to a registered peer
-    db.messages.insert_one(
-            {
-                "recipient_key": recipient_key,
-                "attachment": attachment,
-                "datetime": int(datetime.datetime.now().timestamp())
-            }
+    document = message_document(recipient_key, attachment, due_time, expires_time)
+    await offload_payloads([document])
+    try:
+        result = await message_writes.insert_one(document)
+    except WriteError:
+        if "blob" in document:
+            await remove_blob(document["blob"])
+        raise
+    await update_queue_stats(queue_changes([document], 1))
+    return result.inserted_id
+
+async def add_messages(documents):
+    ''' Store message documents in one bulk insert, each document gets its _id.
+        Raise BulkWriteError if any insert fails, the others are still stored '''
+    await offload_payloads(documents)
+    try:
+        await message_writes.insert_many(documents, ordered=False)
+    except BulkWriteError as ex:
+        failed = {error["index"] for error in ex.details["writeErrors"]}
+        # the failed documents are not stored, their offloaded payloads would be orphaned
+        await asyncio.gather(*[remove_blob(documents[i]["blob"]) for i in failed if "blob" in documents[i]])
+        await update_queue_stats(queue_changes([d for i, d in enumerate(documents) if i not in failed], 1))
+        raise
+    await update_queue_stats(queue_changes(documents, 1))
+
+async def delete_messages(messages):
+    ''' Delete found messages with their blobs and update the queue counters, return how many were deleted '''
+    result = await db.messages.delete_many({"_id": {"$in": [message["_id"] for message in messages]}})
+    await asyncio.gather(*[remove_blob(message["blob"]) for message in messages if "blob" in message])
+    if result.deleted_count == len(messages):
+        await update_queue_stats(queue_changes(messages, -1))
+    else:
+        # some were deleted concurrently, count again
+        await rebuild_queue_stats(list({message["recipient_key"] for message in messages}))
+    return result.deleted_count
+
+def queue_changes(documents, sign):
+    ''' Counter changes of stored (sign 1) or deleted (sign -1) messages by recipient key '''
+    changes = {}
+    for document in documents:
+        received_time = document.get("received_time", document.get("datetime", 0))
+        change = changes.setdefault(document["recipient_key"], {
+            "count": 0, "bytes": 0, "oldest": received_time, "newest": received_time
+        })
+        change["count"] += sign
+        change["bytes"] += sign * document.get("size", 0)
+        change["oldest"] = min(change["oldest"], received_time)
+        change["newest"] = max(change["newest"], received_time)
+    return changes
+
+async def update_queue_stats(changes):
+    ''' Apply queue_changes to the recipient and connection queue statistics '''
+    connections = {}
+    for recipient_key, change in changes.items():
+        update = {"$inc": {"count": change["count"], "bytes": change["bytes"]}}
+        if change["count"] > 0:
+            update["$min"] = {"oldest_received_time": change["oldest"]}
+            update["$max"] = {"newest_received_time": change["newest"]}
+        queue = await db.queues.find_one_and_update(
+            {"_id": recipient_key}, update, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        if change["count"] < 0:
+            await refresh_queue_times(queue, change)
+        # the connection owning the queue when the counters changed, see move_queues
+        connection_id = queue.get("connection_id")
+        if connection_id:
+            connections.setdefault(connection_id, []).append(change)
+    for connection_id, connection_changes in connections.items():
+        update = {"$inc": {
+            "count": sum(change["count"] for change in connection_changes),
+            "bytes": sum(change["bytes"] for change in connection_changes)
+        }}
+        added = [change for change in connection_changes if change["count"] > 0]
+        if added:
+            update["$min"] = {"oldest_received_time": min(change["oldest"] for change in added)}
+            update["$max"] = {"newest_received_time": max(change["newest"] for change in added)}
+        await db.connection_queues.update_one({"_id": connection_id}, update, upsert=True)
+        if len(added) < len(connection_changes):
+            await refresh_connection_times([connection_id])
+
+async def move_queues(connection_id, added, removed):
+    ''' Give the queues of the added keys to connection_id and those of its removed keys to their next owner,
+        moving the counters each queue holds at that moment between the connections '''
+    move = ObjectId()
+    def take_queue(owner):
+        # the previous owner and counters are kept in the queue by the same atomic update
+        return [{"$set": {
+            "move": move,
+            "moved_from": {"$ifNull": ["$connection_id", None]},
+            "moved_count": {"$ifNull": ["$count", 0]},
+            "moved_bytes": {"$ifNull": ["$bytes", 0]},
+            "count": {"$ifNull": ["$count", 0]},
+            "bytes": {"$ifNull": ["$bytes", 0]},
+            "connection_id": owner
+        }}]
+    owners = {}
+    if removed:
+        async for key in db.keys.find({"recipient_did": {"$in": list(removed)}}, {"recipient_did": 1, "connection_id": 1}).sort("_id", 1):
+            owners[key["recipient_did"]] = key["connection_id"]
+    operations = [
+        UpdateOne({"_id": recipient_key}, take_queue(connection_id), upsert=True) for recipient_key in added
+    ] + [
+        UpdateOne({"_id": recipient_key, "connection_id": connection_id}, take_queue(owners.get(recipient_key)))
+        for recipient_key in removed
+    ]
+    if not operations:
+        return
+    await db.queues.bulk_write(operations, ordered=False)
+    moved = {"_id": {"$in": list(added) + list(removed)}, "move": move}
+    changes = {}
+    async for transfer in db.queues.aggregate([
+        {"$match": moved},
+        {"$group": {
+            "_id": {"source": "$moved_from", "target": "$connection_id"},
+            "count": {"$sum": "$moved_count"},
+            "bytes": {"$sum": "$moved_bytes"}
+        }}
+    ]):
+        source, target = transfer["_id"].get("source"), transfer["_id"].get("target")
+        if source == target:
+            continue
+        for owner, sign in ((source, -1), (target, 1)):
+            if owner:
+                change = changes.setdefault(owner, {"count": 0, "bytes": 0})
+                change["count"] += sign * transfer["count"]
+                change["bytes"] += sign * transfer["bytes"]
+    if changes:
+        await db.connection_queues.bulk_write([
+            UpdateOne({"_id": owner}, {"$inc": change}, upsert=True) for owner, change in changes.items()
+        ], ordered=False)
+        await refresh_connection_times(list(changes))
+    await db.queues.update_many(moved, {"$unset": {"move": "", "moved_from": "", "moved_count": "", "moved_bytes": ""}})
+
+async def refresh_queue_times(queue, change):
+    ''' Look up the oldest and newest queued messages again if deleted messages were one of them '''
+    if queue["count"] <= 0:
+        await db.queues.update_one({"_id": queue["_id"]}, {"$unset": {"oldest_received_time": "", "newest_received_time": ""}})
+        return
+    times = {}
+    if change["oldest"] <= queue.get("oldest_received_time", 0):
+        times["oldest_received_time"] = await find_received_time(queue["_id"], 1)
+    if change["newest"] >= queue.get("newest_received_time", 0):
+        times["newest_received_time"] = await find_received_time(queue["_id"], -1)
+    if times:
+        await db.queues.update_one({"_id": queue["_id"]}, {"$set": times})
+
+async def find_received_time(recipient_key, direction):
+    message = await db.messages.find_one(
+        {"recipient_key": recipient_key}, {"received_time": 1, "datetime": 1}, sort=[("received_time", direction)]
+    )
+    return message.get("received_time", message["datetime"]) if message else 0
+
+async def refresh_connection_times(connection_ids):
+    ''' Oldest and newest times of connections from the queues of their keys, with one aggregate '''
+    times = {}
+    async for connection in db.queues.aggregate([
+        {"$match": {"connection_id": {"$in": connection_ids}, "count": {"$gt": 0}}},
+        {"$group": {
+            "_id": "$connection_id",
+            "oldest_received_time": {"$min": "$oldest_received_time"},
+            "newest_received_time": {"$max": "$newest_received_time"}
+        }}
+    ]):
+        if connection.get("oldest_received_time") is not None:
+            times[connection.pop("_id")] = connection
+    await db.connection_queues.bulk_write([
+        UpdateOne({"_id": connection_id}, {"$set": times[connection_id]}) if connection_id in times else
+        UpdateOne({"_id": connection_id}, {"$unset": {"oldest_received_time": "", "newest_received_time": ""}})
+        for connection_id in connection_ids
+    ], ordered=False)
+
+async def rebuild_queue_stats(recipient_keys=None):
+    ''' Recount the queue statistics and owners of recipient_keys, or of all the keys and queued messages '''
+    received_time = {"$ifNull": ["$received_time", "$datetime"]}
+    pipeline = [{"$group": {
+        "_id": "$recipient_key",
+        "count": {"$sum": 1},
+        "bytes": {"$sum": {"$ifNull": ["$size", 0]}},
+        "oldest_received_time": {"$min": received_time},
+        "newest_received_time": {"$max": received_time}
+    }}]
+    key_filter, queue_filter = {}, {}
+    if recipient_keys is not None:
+        recipient_keys = list(recipient_keys)
+        pipeline.insert(0, {"$match": {"recipient_key": {"$in": recipient_keys}}})
+        key_filter = {"recipient_did": {"$in": recipient_keys}}
+        queue_filter = {"_id": {"$in": recipient_keys}}
+    counted = {queue["_id"]: queue async for queue in db.messages.aggregate(pipeline)}
+    # a key registered by several connections belongs to the last one, as in update_keys
+    owners = {}
+    async for key in db.keys.find(key_filter, {"recipient_did": 1, "connection_id": 1}).sort("_id", 1):
+        owners[key["recipient_did"]] = key["connection_id"]
+    previous = {queue["_id"]: queue.get("connection_id") async for queue in db.queues.find(queue_filter, {"connection_id": 1})}
+    if recipient_keys is None:
+        # keys without messages and empty queues may still hold stale counters
+        recipient_keys = set(counted) | set(owners) | set(previous)
+    operations = []
+    for recipient_key in recipient_keys:
+        queue = counted.get(recipient_key, {"count": 0, "bytes": 0})
+        update = {"$set": {"count": queue["count"], "bytes": queue["bytes"], "connection_id": owners.get(recipient_key)}}
+        if queue["count"]:
+            update["$set"]["oldest_received_time"] = queue["oldest_received_time"]
+            update["$set"]["newest_received_time"] = queue["newest_received_time"]
+        else:
+            update["$unset"] = {"oldest_received_time": "", "newest_received_time": ""}
+        operations.append(UpdateOne({"_id": recipient_key}, update, upsert=True))
+    if operations:
+        await db.queues.bulk_write(operations, ordered=False)
+    # the previous owners lost queues and are counted again too
+    connection_ids = list({id for id in [*owners.values(), *previous.values()] if id})
+    if not connection_ids:
+        return
+    totals = {connection_id: {"count": 0, "bytes": 0} for connection_id in connection_ids}
+    async for total in db.queues.aggregate([
+        {"$match": {"connection_id": {"$in": connection_ids}}},
+        {"$group": {"_id": "$connection_id", "count": {"$sum": "$count"}, "bytes": {"$sum": "$bytes"}}}
+    ]):
+        totals[total["_id"]] = {"count": total["count"], "bytes": total["bytes"]}
+    await db.connection_queues.bulk_write([
+        UpdateOne({"_id": connection_id}, {"$set": total}, upsert=True) for connection_id, total in totals.items()
+    ], ordered=False)
+    await refresh_connection_times(connection_ids)
+
+async def migrate_queue_stats():
+    ''' Give every key queue its owner connection and count the queued messages, once per database '''
+    if await db.migrations.find_one({"_id": "queue_stats"}):
+        return
+    await rebuild_queue_stats()
+    await db.migrations.update_one({"_id": "queue_stats"}, {"$set": {"time": epoch_seconds()}}, upsert=True)
+
+async def get_queue_stats(recipient_key):
+    ''' Counters of the recipient key queue and of its connection queue '''
+    queue = await db.queues.find_one({"_id": recipient_key}) or {"count": 0, "bytes": 0}
+    connection_id = queue.get("connection_id")
+    connection_queue = await db.connection_queues.find_one({"_id": connection_id}) if connection_id else None
+    return queue, connection_queue or {"count": 0, "bytes": 0}
+
+async def claim_messages(message_ids, lease_seconds=MESSAGE_LEASE_SECONDS, fields=MESSAGE_FIELDS):
+    ''' Lease visible messages, hiding them from other pickups until the lease ends.
+        Return the messages this call claimed, in the order of message_ids '''
+    if not message_ids:
+        return []
+    if lease_seconds > 0:
+        current_time = epoch_seconds()
+        lease = ObjectId()
+        # datetime keeps the arrival order, the lease is hidden by its own field until it ends
+        await db.messages.update_many(
+            {"_id": {"$in": message_ids}, **visible_filter(current_time)},
+            {"$set": {"lease_until": current_time + lease_seconds, "lease": lease}}
         )
+        claimed = db.messages.find({"_id": {"$in": message_ids}, "lease": lease}, fields)
+    else:
+        claimed = db.messages.find({"_id": {"$in": message_ids}}, fields)
+    messages = {message["_id"]: message async for message in claimed}
+    return [messages[id] for id in message_ids if id in messages]
+
+async def watch_messages(resume_token=None):
+    ''' Iterate over message inserts, needs a replica set '''
+    pipeline = [
+        {"$match": {"operationType": "insert"}},
+        {"$project": {"documentKey": 1, "fullDocument.recipient_key": 1, "fullDocument.datetime": 1}}
+    ]
+    async with db.messages.watch(pipeline, resume_after=resume_token) as stream:
+        async for change in stream:
+            yield change
+
+async def get_key_connection_id(recipient_key):
+    ''' Id of the connection that registered a recipient key '''
+    key = await db.keys.find_one({"recipient_did": recipient_key}, {"connection_id": 1})
+    return key["connection_id"] if key else None
+
+async def remove_messages(remote_did, message_id_list, recipient_key=None):
+    ''' Delete acknowledged messages of the connection keys in one bulk delete.
+        Return the queue statistics of recipient_key, or of all the connection keys '''
+    recipient_keys = await get_recipient_keys(remote_did, None)
+    ids = [ObjectId(id) for id in message_id_list if ObjectId.is_valid(id)]
+    if ids and recipient_keys:
+        messages = await db.messages.find(
+            {"_id": {"$in": ids}, "recipient_key": {"$in": recipient_keys}}, QUEUE_FIELDS
+        ).to_list(None)
+        if messages:
+            await delete_messages(messages)
+    return await get_message_status(remote_did, recipient_key)
 
-def remove_messages(remote_did, message_id_list):
-    #TODO verify that recipient_key belongs to remote_did
-    for id in message_id_list:
-        db.messages.delete_one({"_id": ObjectId(id)})
-    return get_message_status(remote_did, None)
+async def remove_expired_messages(limit):
+    ''' Delete up to limit expired messages and their blobs, return how many were deleted '''
+    expired = await db.messages.find(
+        {"expires_time": {"$lte": epoch_seconds()}}, QUEUE_FIELDS
+    ).sort("expires_time", 1).limit(limit).to_list(None)
+    if expired:
+        await delete_messages(expired)
+    return len(expired)
 
-def get_short_url(oobid):
-    short_url = db.shortUrls.find_one({"oobid": oobid},sort=[('date', -1)])
+async def get_short_url(oobid):
+    short_url = await db.shortUrls.find_one({"oobid": oobid},sort=[('date', -1)])
     return short_url
 
-def store_short_url(short_url):
-    db.shortUrls.insert_one(short_url)
+async def store_short_url(short_url):
+    await db.shortUrls.insert_one(short_url)
 
-def expire_short_url(oobid):
+async def expire_short_url(oobid):
         # TODO order by date
-        db.shortUrls.update_one(
+        await db.shortUrls.update_one(
             {"oobid": oobid}, {
                 "$set": {
                             "expires_time": int(0)
                         }
             }
         )
-    
\ No newline at end of file
+    
+
+async def add_outbound_message(url, payload):
+    ''' Queue a packed message for delivery to an HTTP endpoint '''
+    now = datetime.datetime.now().timestamp()
+    await db.outbound.insert_one(
+            {
+                "url": url,
+                "payload": payload,
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt": now,
+                "creation_time": int(now)
+            }
+        )
+
+async def claim_outbound_message(lease_seconds):
+    ''' Take the next due outbound message, hiding it from other senders for lease_seconds '''
+    now = datetime.datetime.now().timestamp()
+    return await db.outbound.find_one_and_update(
+        {"status": "pending", "next_attempt": {"$lte": now}},
+        {"$set": {"next_attempt": now + lease_seconds}, "$inc": {"attempts": 1}},
+        sort=[("next_attempt", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def remove_outbound_message(id):
+    await db.outbound.delete_one({"_id": id})
+
+async def retry_outbound_message(id, next_attempt, error, dead):
+    ''' Schedule another delivery attempt, or move the message to dead-letter '''
+    await db.outbound.update_one(
+        {"_id": id}, {
+            "$set": {
+                        "status": "dead" if dead else "pending",
+                        "next_attempt": next_attempt,
+                        "last_error": error
+                    }
+        }
+    )
@@ -0,0 +1,32 @@
+""" Per-connection lanes: messages of one connection run one at a time, in arrival order """
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict
+
+
+class Lane:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+lanes: Dict[str, Lane] = {}
+
+
+@asynccontextmanager
+async def connection_lane(remote_did: str):
+    """ Wait for the previous messages of remote_did, other connections are not blocked.
+        asyncio.Lock wakes up waiters in FIFO order, lanes are dropped once idle """
+    lane = lanes.get(remote_did)
+    if not lane:
+        lane = lanes[remote_did] = Lane()
+    lane.users += 1
+    try:
+        async with lane.lock:
+            yield
+    finally:
+        lane.users -= 1
+        if not lane.users:
+            del lanes[remote_did]
@@ -0,0 +1,139 @@
+""" Worker pool for DIDComm pack/unpack cryptography """
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional
+from didcomm.common.resolvers import ResolversConfig
+from didcomm.common.types import DID_OR_DID_URL, DID_URL
+from didcomm.message import Message
+from didcomm.pack_encrypted import pack_encrypted as didcomm_pack_encrypted
+from didcomm.pack_encrypted import PackEncryptedConfig, PackEncryptedParameters, PackEncryptedResult
+from didcomm.secrets.secrets_resolver import Secret, SecretsResolver
+from didcomm.secrets.secrets_resolver_in_memory import SecretsResolverInMemory
+from didcomm.unpack import unpack as didcomm_unpack
+from didcomm.unpack import UnpackConfig, UnpackResult
+
+# "none" runs the cryptography on the event loop, "thread" or "process" in a worker pool
+CRYPTO_POOL = os.environ["CRYPTO_POOL"] if "CRYPTO_POOL" in os.environ else "none"
+CRYPTO_WORKERS = int(os.environ["CRYPTO_WORKERS"]) if "CRYPTO_WORKERS" in os.environ else (os.cpu_count() or 1)
+CRYPTO_QUEUE_SIZE = int(os.environ["CRYPTO_QUEUE_SIZE"]) if "CRYPTO_QUEUE_SIZE" in os.environ else 1000
+
+
+class CryptoQueueFull(Exception):
+    """ Too many pack/unpack jobs waiting for the crypto pool """
+
+
+executor: Optional[Executor] = None
+slots: Optional[asyncio.Semaphore] = None
+pending = 0
+worker_state = threading.local()
+
+
+def get_executor() -> Executor:
+    global executor
+    if not executor:
+        if CRYPTO_POOL == "process":
+            executor = ProcessPoolExecutor(max_workers=CRYPTO_WORKERS)
+        else:
+            executor = ThreadPoolExecutor(max_workers=CRYPTO_WORKERS, thread_name_prefix="crypto")
+    return executor
+
+
+def _run_in_worker(function, kwargs):
+    """ Run a didcomm coroutine on the worker's own event loop """
+    if not hasattr(worker_state, "loop"):
+        worker_state.loop = asyncio.new_event_loop()
+    return worker_state.loop.run_until_complete(function(**kwargs))
+
+
+async def _submit(function, **kwargs):
+    global slots, pending
+    if pending >= CRYPTO_QUEUE_SIZE:
+        raise CryptoQueueFull("Crypto queue is full")
+    if not slots:
+        slots = asyncio.Semaphore(CRYPTO_WORKERS)
+    pending += 1
+    try:
+        async with slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                get_executor(), _run_in_worker, function, kwargs)
+    finally:
+        pending -= 1
+
+
+def recipient_kids(packed_msg) -> List[DID_URL]:
+    """ Recipient kids in the header of an encrypted message, empty if it is not a JWE """
+    try:
+        msg = json.loads(packed_msg) if isinstance(packed_msg, str) else packed_msg
+        return [r["header"]["kid"] for r in msg["recipients"]]
+    except (ValueError, TypeError, KeyError):
+        return []
+
+
+async def _load_secrets(secrets_resolver: SecretsResolver, kids: List[DID_URL]) -> List[Secret]:
+    """ Fetch the secrets on the event loop so workers don't need the secrets store """
+    secrets = []
+    for kid in await secrets_resolver.get_keys(kids):
+        secret = await secrets_resolver.get_key(kid)
+        if secret:
+            secrets.append(secret)
+    return secrets
+
+
+async def pack_encrypted(
+    resolvers_config: ResolversConfig,
+    message: Message,
+    to: DID_OR_DID_URL,
+    frm: Optional[DID_OR_DID_URL] = None,
+    sign_frm: Optional[DID_OR_DID_URL] = None,
+    pack_config: Optional[PackEncryptedConfig] = None,
+    pack_params: Optional[PackEncryptedParameters] = None,
+) -> PackEncryptedResult:
+    """ Same as didcomm pack_encrypted, running the cryptography in the crypto pool """
+    if CRYPTO_POOL == "none":
+        return await didcomm_pack_encrypted(resolvers_config, message, to, frm, sign_frm, pack_config, pack_params)
+
+    kids = []
+    from_prior_iss = message.from_prior.iss if message.from_prior else None
+    for did in (frm, sign_frm, from_prior_iss):
+        if did and "#" in did:
+            kids.append(did)
+        elif did:
+            did_doc = await resolvers_config.did_resolver.resolve(did)
+            kids += did_doc.key_agreement_kids + did_doc.authentication_kids
+    return await _submit(
+        didcomm_pack_encrypted,
+        resolvers_config=ResolversConfig(
+            secrets_resolver=SecretsResolverInMemory(await _load_secrets(resolvers_config.secrets_resolver, kids)),
+            did_resolver=resolvers_config.did_resolver
+        ),
+        message=message,
+        to=to,
+        frm=frm,
+        sign_frm=sign_frm,
+        pack_config=pack_config,
+        pack_params=pack_params
+    )
+
+
+async def unpack(
+    resolvers_config: ResolversConfig,
+    packed_msg,
+    unpack_config: Optional[UnpackConfig] = None,
+) -> UnpackResult:
+    """ Same as didcomm unpack, running the cryptography in the crypto pool """
+    if CRYPTO_POOL == "none":
+        return await didcomm_unpack(resolvers_config, packed_msg, unpack_config)
+
+    kids = recipient_kids(packed_msg)
+    return await _submit(
+        didcomm_unpack,
+        resolvers_config=ResolversConfig(
+            secrets_resolver=SecretsResolverInMemory(await _load_secrets(resolvers_config.secrets_resolver, kids)),
+            did_resolver=resolvers_config.did_resolver
+        ),
+        packed_msg=packed_msg,
+        unpack_config=unpack_config
+    )
@@ -0,0 +1,35 @@
+""" Refresh of the recipient kids known to the inbound kid filter """
+import asyncio
+import os
+from didcomm_v2.peer_did import get_secret_resolver
+
+KID_REFRESH_SECONDS = float(os.environ["KID_REFRESH_SECONDS"]) if "KID_REFRESH_SECONDS" in os.environ else 5.0
+
+refresh_task = None
+
+
+async def kid_refresher():
+    """ Load the kids stored by other workers every KID_REFRESH_SECONDS """
+    while True:
+        await asyncio.sleep(KID_REFRESH_SECONDS)
+        try:
+            await get_secret_resolver().refresh_kids()
+        except Exception as ex:
+            print("ERROR: Kids refresh failed", ex)
+
+
+def start_kid_refresh():
+    global refresh_task
+    if not refresh_task:
+        refresh_task = asyncio.create_task(kid_refresher())
+
+
+async def stop_kid_refresh():
+    global refresh_task
+    if refresh_task:
+        refresh_task.cancel()
+        try:
+            await refresh_task
+        except asyncio.CancelledError:
+            pass
+        refresh_task = None
@@ -0,0 +1,96 @@
+""" Pickup 3.0 live delivery over WebSocket """
+import asyncio
+import uuid
+from contextvars import ContextVar
+from typing import Dict, Optional, Set
+from fastapi import WebSocket
+from didcomm.message import Message, Attachment, AttachmentDataJson
+from didcomm_v2.pack_reply import pack_reply
+from didcomm_v2.notification_bus import subscribe
+from db_utils import get_key_connection_id, claim_messages, load_attachment, MESSAGE_FIELDS
+
+
+class LiveSession:
+    """ WebSocket connection of an agent, live when live delivery is enabled """
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.connection_id = None
+        self.remote_did = None
+        self.local_did = None
+        self.lock = asyncio.Lock()
+
+    async def send(self, packed_msg: str):
+        async with self.lock:
+            await self.websocket.send_text(packed_msg)
+
+
+# session of the WebSocket the message being processed arrived on
+current_session: ContextVar[Optional[LiveSession]] = ContextVar("current_session", default=None)
+# live sessions by connection id
+sessions: Dict[object, Set[LiveSession]] = {}
+push_tasks = set()
+
+
+def get_current_session() -> Optional[LiveSession]:
+    return current_session.get()
+
+
+def enable_live_delivery(session: LiveSession, connection_id, remote_did: str, local_did: str):
+    disable_live_delivery(session)
+    session.connection_id = connection_id
+    session.remote_did = remote_did
+    session.local_did = local_did
+    sessions.setdefault(connection_id, set()).add(session)
+
+
+def disable_live_delivery(session: LiveSession):
+    if session.connection_id in sessions:
+        sessions[session.connection_id].discard(session)
+        if not sessions[session.connection_id]:
+            del sessions[session.connection_id]
+    session.connection_id = None
+
+
+def is_live(session: Optional[LiveSession]) -> bool:
+    return session is not None and session.connection_id is not None
+
+
+def push_message(recipient_key: str, message_id, attachment=None):
+    """ Push a stored message to the live sessions owning recipient_key, without waiting """
+    if not sessions:
+        return
+    task = asyncio.create_task(deliver_live(recipient_key, message_id, attachment))
+    push_tasks.add(task)
+    task.add_done_callback(push_tasks.discard)
+
+
+async def deliver_live(recipient_key: str, message_id, attachment):
+    connection_id = await get_key_connection_id(recipient_key)
+    if connection_id not in sessions:
+        return
+    # lease the message like a pickup does, so it is not delivered twice
+    claimed = await claim_messages([message_id], fields=MESSAGE_FIELDS if attachment is None else {"_id": 1})
+    if not claimed:
+        return
+    if attachment is None:
+        attachment = await load_attachment(claimed[0])
+    for session in list(sessions.get(connection_id, ())):
+        response_message = Message(
+            id=str(uuid.uuid4()),
+            type="https://didcomm.org/messagepickup/3.0/delivery",
+            body={
+                    "recipient_key": recipient_key,
+            },
+            attachments = [Attachment(
+                id=str(message_id),
+                data=AttachmentDataJson(json=attachment)
+            )]
+        )
+        try:
+            await session.send(await pack_reply(response_message, session.local_did, session.remote_did))
+        except Exception as ex:
+            print("ERROR: Live delivery failed", ex)
+            disable_live_delivery(session)
+
+
+subscribe(push_message)
@@ -0,0 +1,37 @@
+""" Removal of expired queued messages """
+import asyncio
+import os
+from db_utils import remove_expired_messages
+
+MESSAGE_SWEEP_SECONDS = float(os.environ["MESSAGE_SWEEP_SECONDS"]) if "MESSAGE_SWEEP_SECONDS" in os.environ else 60.0
+MESSAGE_SWEEP_BATCH = 1000
+
+sweeper_task = None
+
+
+async def expiry_sweeper():
+    """ Delete expired messages in batches every MESSAGE_SWEEP_SECONDS """
+    while True:
+        try:
+            while await remove_expired_messages(MESSAGE_SWEEP_BATCH) == MESSAGE_SWEEP_BATCH:
+                pass
+        except Exception as ex:
+            print("ERROR: Expired messages sweep failed", ex)
+        await asyncio.sleep(MESSAGE_SWEEP_SECONDS)
+
+
+def start_expiry_sweeper():
+    global sweeper_task
+    if not sweeper_task:
+        sweeper_task = asyncio.create_task(expiry_sweeper())
+
+
+async def stop_expiry_sweeper():
+    global sweeper_task
+    if sweeper_task:
+        sweeper_task.cancel()
+        try:
+            await sweeper_task
+        except asyncio.CancelledError:
+            pass
+        sweeper_task = None
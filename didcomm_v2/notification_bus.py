@@ -0,0 +1,68 @@
+""" Notification bus for "new message for recipient_key" events between mediator processes """
+import asyncio
+import datetime
+import os
+from db_utils import watch_messages
+
+# "local" notifies subscribers of this process only, "mongo" notifies every process via a change stream
+NOTIFICATION_BUS = os.environ["NOTIFICATION_BUS"] if "NOTIFICATION_BUS" in os.environ else "local"
+NOTIFICATION_RETRY_SECONDS = 5.0
+
+subscribers = []
+watch_task = None
+
+
+def subscribe(callback):
+    """ Call callback(recipient_key, message_id, attachment) on every new message,
+        attachment is None when the message was stored by another process """
+    subscribers.append(callback)
+
+
+def notify(recipient_key: str, message_id, attachment=None):
+    for callback in subscribers:
+        try:
+            callback(recipient_key, message_id, attachment)
+        except Exception as ex:
+            print("ERROR: Notification subscriber failed", ex)
+
+
+def publish(recipient_key: str, message_id, attachment=None):
+    """ Announce a stored message """
+    if NOTIFICATION_BUS == "local":
+        notify(recipient_key, message_id, attachment)
+    # with the mongo bus the change stream notifies every process, this one included
+
+
+async def watch_notifications():
+    """ Relay message inserts seen by the change stream, resuming after errors """
+    resume_token = None
+    while True:
+        try:
+            async for change in watch_messages(resume_token):
+                resume_token = change["_id"]
+                # delayed messages are not announced, pickup finds them once due
+                if change["fullDocument"].get("datetime", 0) > datetime.datetime.now().timestamp():
+                    continue
+                notify(change["fullDocument"]["recipient_key"], change["documentKey"]["_id"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            print("ERROR: Notification change stream failed", ex)
+            await asyncio.sleep(NOTIFICATION_RETRY_SECONDS)
+
+
+def start_notification_bus():
+    global watch_task
+    if NOTIFICATION_BUS == "mongo" and not watch_task:
+        watch_task = asyncio.create_task(watch_notifications())
+
+
+async def stop_notification_bus():
+    global watch_task
+    if watch_task:
+        watch_task.cancel()
+        try:
+            await watch_task
+        except asyncio.CancelledError:
+            pass
+        watch_task = None
@@ -0,0 +1,31 @@
+""" Shared packing of mediator replies """
+from didcomm.common.resolvers import ResolversConfig
+from didcomm.message import Message
+from didcomm.pack_encrypted import PackEncryptedConfig
+from didcomm_v2.crypto_pool import pack_encrypted
+from didcomm_v2.peer_did import get_secret_resolver
+from didcomm_v2.peer_did import DIDResolverPeerDID
+
+resolvers_config = ResolversConfig(
+    secrets_resolver=get_secret_resolver(),
+    did_resolver=DIDResolverPeerDID()
+)
+pack_config = PackEncryptedConfig(protect_sender_id=False)
+
+
+def get_resolvers_config() -> ResolversConfig:
+    """ Resolvers config singleton """
+    return resolvers_config
+
+
+async def pack_reply(message: Message, frm: str, to: str) -> str:
+    """ Encrypt a message from a mediator DID to a remote DID """
+    packed = await pack_encrypted(
+        resolvers_config=resolvers_config,
+        message=message,
+        frm=frm,
+        to=to,
+        sign_frm=None,
+        pack_config=pack_config
+    )
+    return packed.packed_msg
@@ -1,6 +1,11 @@
 """ Peer DID helpers"""
+import asyncio
+import datetime
+import hashlib
 import json
-from typing import Optional, List
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional, List, Tuple
 from didcomm.secrets.secrets_util import generate_x25519_keys_as_jwk_dict, generate_ed25519_keys_as_jwk_dict, jwk_to_secret
 from didcomm.did_doc.did_doc import DIDDoc, VerificationMethod, DIDCommService
 from didcomm.common.types import DID, DID_URL, VerificationMethodType, VerificationMaterial, VerificationMaterialFormat
@@ -11,88 +16,237 @@ from peerdid.core.did_doc_types import DIDCommServicePeerDID
 from peerdid import peer_did
 from peerdid.did_doc import DIDDocPeerDID
 from peerdid.types import VerificationMaterialAuthentication, VerificationMethodTypeAuthentication, VerificationMaterialAgreement, VerificationMethodTypeAgreement, VerificationMaterialFormatPeerDID
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from bson.objectid import ObjectId
+from db_utils import DB_MAX_POOL_SIZE, DB_MIN_POOL_SIZE
 import os
+import time
 import urllib.parse
 
+DID_CACHE_SIZE = int(os.environ["DID_CACHE_SIZE"]) if "DID_CACHE_SIZE" in os.environ else 1024
+SECRETS_CACHE_SIZE = int(os.environ["SECRETS_CACHE_SIZE"]) if "SECRETS_CACHE_SIZE" in os.environ else 4096
+# check the recipient kids of inbound messages against the kids of db.secrets before decrypting
+KID_FILTER = os.environ["KID_FILTER"] == "1" if "KID_FILTER" in os.environ else True
+# seconds of clock skew between workers tolerated when refreshing the kids of db.secrets
+KID_REFRESH_MARGIN = 60
+# min seconds between the refreshes started by unknown kids, the kids still unknown afterwards are remembered
+KID_MISS_REFRESH_SECONDS = float(os.environ["KID_MISS_REFRESH_SECONDS"]) if "KID_MISS_REFRESH_SECONDS" in os.environ else 1.0
+UNKNOWN_KIDS_CACHE_SIZE = 10000
+
 class SecretsResolverMongo(SecretsResolverEditable):
     """ Secret Resolver on MongoDB"""
     def __init__(self, mongo_db_uri=os.environ["DB_URL"]):
         #self.mongo = MongoClient(mongo_db_uri)
-        self.mongo = MongoClient(
+        self.mongo = AsyncIOMotorClient(
             mongo_db_uri,
             username=urllib.parse.quote_plus(os.environ["MONGODB_USER"]) if "MONGODB_USER" in os.environ else None,
             password=urllib.parse.quote_plus(os.environ["MONGODB_PASSWORD"]) if "MONGODB_PASSWORD" in os.environ else None,
-            authSource='admin'
+            authSource='admin',
+            maxPoolSize=DB_MAX_POOL_SIZE,
+            minPoolSize=DB_MIN_POOL_SIZE
         )
         self.db = self.mongo.mediator
         self.secrets = self.db.secrets
+        # write-through LRU cache of parsed secrets by kid
+        self.cache = OrderedDict()
+        # 64 bit hashes of all the kids in db.secrets, None until loaded
+        self.kid_hashes = None
+        # secrets inserted from this _id on are read again by refresh_kids
+        self.kids_since = None
+        # the refresh in progress, shared by the callers, and the time unknown kids last started one
+        self.kids_refresh = None
+        self.kids_miss_refreshed = 0.0
+        # kids still unknown after a refresh, until the periodic refresh finds them
+        self.unknown_kids = OrderedDict()
 
-    async def add_key(self, secret: Secret):
-        self.secrets.insert_one({
+    def _cache_secret(self, secret: Secret):
+        self.cache[secret.kid] = secret
+        self.cache.move_to_end(secret.kid)
+        if len(self.cache) > SECRETS_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def _to_secret(self, key) -> Secret:
+        return Secret(
+            key["kid"],
+            VerificationMethodType(key["type"]),
+            VerificationMaterial(VerificationMaterialFormat(
+                    key["verification_material"]["format"]),
+                    key["verification_material"]["value"]
+                    )
+            )
+
+    def _to_document(self, secret: Secret) -> dict:
+        return {
             "kid": secret.kid,
             "type": secret.type.value,
             "verification_material": {
                 "format": secret.verification_material.format.value,
                 "value": secret.verification_material.value
             }
-        })
+        }
+
+    @staticmethod
+    def _kid_hash(kid: DID_URL) -> int:
+        return int.from_bytes(hashlib.blake2b(kid.encode(), digest_size=8).digest(), "big")
+
+    def _add_kid(self, kid: DID_URL):
+        if self.kid_hashes is not None:
+            self.kid_hashes.add(self._kid_hash(kid))
+
+    async def add_key(self, secret: Secret):
+        await self.secrets.insert_one(self._to_document(secret))
+        self._cache_secret(secret)
+        self._add_kid(secret.kid)
+
+    async def add_keys(self, secrets: List[Secret]):
+        """ Store several secrets with a single bulk insert """
+        if not secrets:
+            return
+        await self.secrets.insert_many([self._to_document(s) for s in secrets], ordered=False)
+        for secret in secrets:
+            self._cache_secret(secret)
+            self._add_kid(secret.kid)
+
+    def _kids_cursor(self, filter: dict):
+        # ObjectIds start with their creation time, a margin covers the clocks of the other workers
+        self.kids_since = ObjectId.from_datetime(
+            datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=KID_REFRESH_MARGIN))
+        return self.secrets.find(filter, {"_id": 0, "kid": 1})
+
+    async def load_kids(self):
+        """ Load the hashes of all the kids in db.secrets for has_kids """
+        kid_hashes = set()
+        async for key in self._kids_cursor({}):
+            kid_hashes.add(self._kid_hash(key["kid"]))
+        self.kid_hashes = kid_hashes
+
+    async def _load_new_kids(self):
+        if self.kid_hashes is None:
+            return await self.load_kids()
+        async for key in self._kids_cursor({"_id": {"$gte": self.kids_since}}):
+            self.kid_hashes.add(self._kid_hash(key["kid"]))
+
+    async def refresh_kids(self):
+        """ Add the kids stored by other workers since the last load or refresh.
+            Concurrent callers share a single query """
+        if not self.kids_refresh:
+            self.kids_refresh = asyncio.ensure_future(self._load_new_kids())
+            self.kids_refresh.add_done_callback(lambda _: setattr(self, "kids_refresh", None))
+        await asyncio.shield(self.kids_refresh)
+
+    def _knows_kid(self, kids: List[DID_URL]) -> bool:
+        return any(self._kid_hash(kid) in self.kid_hashes for kid in kids)
+
+    async def has_kids(self, kids: List[DID_URL]) -> bool:
+        """ False only if none of the kids belongs to this mediator. Unknown kids start a refresh,
+            at most one every KID_MISS_REFRESH_SECONDS, and are remembered if it doesn't find them """
+        if not KID_FILTER or self.kid_hashes is None or not kids:
+            return True
+        if self._knows_kid(kids):
+            return True
+        candidates = [kid for kid in kids if kid not in self.unknown_kids]
+        if not candidates:
+            return False
+        # a DID just created by another worker may already be in use
+        if self.kids_refresh:
+            await self.refresh_kids()
+            return self._knows_kid(candidates)
+        if time.monotonic() - self.kids_miss_refreshed < KID_MISS_REFRESH_SECONDS:
+            return False
+        self.kids_miss_refreshed = time.monotonic()
+        await self.refresh_kids()
+        if self._knows_kid(candidates):
+            return True
+        for kid in candidates:
+            self.unknown_kids[kid] = True
+            if len(self.unknown_kids) > UNKNOWN_KIDS_CACHE_SIZE:
+                self.unknown_kids.popitem(last=False)
+        return False
 
     async def get_kids(self) -> List[str]:
         kids = self.secrets.find({},{"kid": 1})
-        return [k["kid"] for k in kids]
+        return [k["kid"] async for k in kids]
     async def get_key(self, kid: DID_URL) -> Optional[Secret]:
-        try:
-            key = self.secrets.find({"kid": kid})[0]
-            return Secret(
-                kid,
-                VerificationMethodType(key["type"]),
-                VerificationMaterial(VerificationMaterialFormat(
-                        key["verification_material"]["format"]),
-                        key["verification_material"]["value"]
-                        )
-                )
-        except IndexError:
+        if kid in self.cache:
+            self.cache.move_to_end(kid)
+            return self.cache[kid]
+        key = await self.secrets.find_one({"kid": kid})
+        if key:
+            secret = self._to_secret(key)
+            self._cache_secret(secret)
+            return secret
+        else:
             return None
 
     async def get_keys(self, kids: List[DID_URL]) -> List[DID_URL]:
-        kids_db = self.secrets.find({"kid": { "$in": kids }},{"kid": 1})
-        return [k["kid"] for k in kids_db]
+        missing = [kid for kid in kids if kid not in self.cache]
+        if missing:
+            async for key in self.secrets.find({"kid": { "$in": missing }}):
+                self._cache_secret(self._to_secret(key))
+        return [kid for kid in kids if kid in self.cache]
+
+    async def warm_up(self, dids: List[DID]):
+        """ Load into the cache the secrets of the given DIDs with a single query """
+        kids = []
+        for did in dids:
+            did_doc = resolve_did_doc(did)
+            kids += did_doc.key_agreement_kids + did_doc.authentication_kids
+        await self.get_keys(kids[:SECRETS_CACHE_SIZE])
 
 class DIDResolverPeerDID(DIDResolver):
     """ Helper class to resolve Peer DID Documents """
     async def resolve(self, did: DID) -> DIDDoc:
-        did_doc_json = peer_did.resolve_peer_did(
-            did, format=VerificationMaterialFormatPeerDID.JWK)
-        did_doc = DIDDocPeerDID.from_json(did_doc_json)
-
-        return DIDDoc(
-            did=did_doc.did,
-            key_agreement_kids=did_doc.agreement_kids,
-            authentication_kids=did_doc.auth_kids,
-            verification_methods=[
-                VerificationMethod(
-                    id=m.id,
-                    type=VerificationMethodType.JSON_WEB_KEY_2020,
-                    controller=m.controller,
-                    verification_material=VerificationMaterial(
-                        format=VerificationMaterialFormat.JWK,
-                        value=json.dumps(m.ver_material.value)
-                    )
+        return resolve_did_doc(did)
+
+
+@lru_cache(maxsize=DID_CACHE_SIZE)
+def resolve_peer_did(did: DID) -> dict:
+    """ Resolve a Peer DID into its DID Document dict (JWK format).
+        Peer DIDs are self-certifying and immutable, so results are cached.
+        The returned dict is shared and must not be modified """
+    return json.loads(peer_did.resolve_peer_did(did, format=VerificationMaterialFormatPeerDID.JWK))
+
+
+@lru_cache(maxsize=DID_CACHE_SIZE)
+def resolve_did_doc(did: DID) -> DIDDoc:
+    """ Resolve a Peer DID into a DIDComm DID Doc. Results are cached """
+    did_doc = DIDDocPeerDID.from_json(json.dumps(resolve_peer_did(did)))
+
+    return DIDDoc(
+        did=did_doc.did,
+        key_agreement_kids=did_doc.agreement_kids,
+        authentication_kids=did_doc.auth_kids,
+        verification_methods=[
+            VerificationMethod(
+                id=m.id,
+                type=VerificationMethodType.JSON_WEB_KEY_2020,
+                controller=m.controller,
+                verification_material=VerificationMaterial(
+                    format=VerificationMaterialFormat.JWK,
+                    value=json.dumps(m.ver_material.value)
                 )
-                for m in did_doc.authentication + did_doc.key_agreement
-            ],
-            didcomm_services=[]
-            #     DIDCommService(
-            #         id=s.id,
-            #         service_endpoint=s.service_endpoint,
-            #         routing_keys=s.routing_keys,
-            #         accept=s.accept
-            #     )
-            #     for s in did_doc.service
-            #     if isinstance(s, DIDCommServicePeerDID)
-            # ] if did_doc.service else []
-        )
+            )
+            for m in did_doc.authentication + did_doc.key_agreement
+        ],
+        didcomm_services=[]
+        #     DIDCommService(
+        #         id=s.id,
+        #         service_endpoint=s.service_endpoint,
+        #         routing_keys=s.routing_keys,
+        #         accept=s.accept
+        #     )
+        #     for s in did_doc.service
+        #     if isinstance(s, DIDCommServicePeerDID)
+        # ] if did_doc.service else []
+    )
+
+
+def did_cache_info() -> dict:
+    """ Hit/miss counters of the DID resolution caches """
+    return {
+        "peer_did": resolve_peer_did.cache_info()._asdict(),
+        "did_doc": resolve_did_doc.cache_info()._asdict()
+    }
 
 
 async def create_peer_did(self,
@@ -102,6 +256,17 @@ async def create_peer_did(self,
                           service_routing_keys: Optional[List[str]] = None
                           ) -> str:
     """ Helper function to create a Peer DID """
+    did, secrets = generate_peer_did(auth_keys_count, agreement_keys_count, service_endpoint, service_routing_keys)
+    await secrets_resolver.add_keys(secrets)
+    return did
+
+
+def generate_peer_did(auth_keys_count: int = 1,
+                      agreement_keys_count: int = 1,
+                      service_endpoint: Optional[str] = None,
+                      service_routing_keys: Optional[List[str]] = None
+                      ) -> Tuple[str, List[Secret]]:
+    """ Generate a Peer DID and its secrets without storing them """
     # 1. generate keys in JWK format
     agreem_keys = [generate_x25519_keys_as_jwk_dict()
                    for _ in range(agreement_keys_count)]
@@ -150,19 +315,20 @@ async def create_peer_did(self,
             service=service,
         )
 
-    # 5. set KIDs as in DID DOC for secrets and store the secret in the secrets resolver
-    did_doc = DIDDocPeerDID.from_json(peer_did.resolve_peer_did(did))
-    for auth_key, kid in zip(auth_keys, did_doc.auth_kids):
+    # 5. set KIDs as in DID DOC for secrets
+    did_doc = resolve_did_doc(did)
+    secrets = []
+    for auth_key, kid in zip(auth_keys, did_doc.authentication_kids):
         private_key = auth_key[0]
         private_key["kid"] = kid
-        await secrets_resolver.add_key(jwk_to_secret(private_key))
+        secrets.append(jwk_to_secret(private_key))
 
-    for agreem_key, kid in zip(agreem_keys, did_doc.agreement_kids):
+    for agreem_key, kid in zip(agreem_keys, did_doc.key_agreement_kids):
         private_key = agreem_key[0]
         private_key["kid"] = kid
-        await secrets_resolver.add_key(jwk_to_secret(private_key))
+        secrets.append(jwk_to_secret(private_key))
 
-    return did
+    return did, secrets
 
 secrets_resolver = SecretsResolverMongo()
 
@@ -0,0 +1,65 @@
+""" Pool of pre-generated Peer DIDs """
+import asyncio
+import os
+from typing import Dict
+from didcomm_v2.peer_did import create_peer_did, generate_peer_did, get_secret_resolver
+
+PEER_DID_POOL_SIZE = int(os.environ["PEER_DID_POOL_SIZE"]) if "PEER_DID_POOL_SIZE" in os.environ else 20
+
+
+class PeerDIDPool:
+    """ Keeps a number of ready to use Peer DIDs for a service endpoint.
+        DIDs are generated in a background task and their secrets stored in bulk """
+    def __init__(self, service_endpoint: str, size: int = PEER_DID_POOL_SIZE):
+        self.service_endpoint = service_endpoint
+        self.size = size
+        self.dids = asyncio.Queue()
+        self.refill = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        if not self.task and self.size > 0:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            missing = self.size - self.dids.qsize()
+            if missing > 0:
+                try:
+                    generated = await asyncio.gather(*[
+                        loop.run_in_executor(None, generate_peer_did, 1, 1, self.service_endpoint)
+                        for _ in range(missing)
+                    ])
+                    await get_secret_resolver().add_keys([s for _, secrets in generated for s in secrets])
+                except Exception as ex:
+                    print("ERROR: Peer DID pool refill failed", ex)
+                    await asyncio.sleep(1)
+                    continue
+                for did, _ in generated:
+                    self.dids.put_nowait(did)
+            self.refill.clear()
+            await self.refill.wait()
+
+    async def get(self) -> str:
+        """ Take a Peer DID from the pool, or create one inline if the pool is empty """
+        self.start()
+        try:
+            did = self.dids.get_nowait()
+        except asyncio.QueueEmpty:
+            did = await create_peer_did(1, 1, service_endpoint=self.service_endpoint)
+        self.refill.set()
+        return did
+
+
+pools: Dict[str, PeerDIDPool] = {}
+
+def get_pool(service_endpoint: str) -> PeerDIDPool:
+    """ Pool for a service endpoint, created on first use """
+    if service_endpoint not in pools:
+        pools[service_endpoint] = PeerDIDPool(service_endpoint)
+    return pools[service_endpoint]
+
+async def get_peer_did(service_endpoint: str) -> str:
+    """ Get a ready to use Peer DID with the given service endpoint """
+    return await get_pool(service_endpoint).get()
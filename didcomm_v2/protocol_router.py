@@ -0,0 +1,33 @@
+""" Protocol handler registry """
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+
+class ProtocolHandler(NamedTuple):
+    handler: Callable
+    # handlers that need a connection get the sender DID, connection DID and from_prior
+    requires_connection: bool
+
+
+handlers: Dict[Tuple[str, str, str], ProtocolHandler] = {}
+
+
+def parse_message_type(message_type: str) -> Tuple[str, str, str]:
+    """ Split a message type URI into (protocol, version, message name) """
+    protocol, version, name = message_type.rsplit("/", 2)
+    return protocol, version, name
+
+
+def register(protocol: str, version: str, name: str, requires_connection: bool = True):
+    """ Decorator to register a protocol message handler """
+    def decorator(handler: Callable):
+        handlers[(protocol, version, name)] = ProtocolHandler(handler, requires_connection)
+        return handler
+    return decorator
+
+
+def get_handler(message_type: str) -> Optional[ProtocolHandler]:
+    """ Find the handler for a message type """
+    try:
+        return handlers.get(parse_message_type(message_type))
+    except ValueError:
+        return None
@@ -1,22 +1,46 @@
-from didcomm_v2.peer_did import  create_peer_did
+from didcomm_v2.peer_did_pool import get_peer_did
 from didcomm.message import Message
 from didcomm.message import Attachment, AttachmentDataJson
-from didcomm.pack_encrypted import pack_encrypted, PackEncryptedConfig
-from didcomm.common.resolvers import ResolversConfig
-from didcomm_v2.peer_did import DIDResolverPeerDID
-from didcomm_v2.peer_did import get_secret_resolver
-from peerdid import peer_did
-import requests
+from didcomm_v2.pack_reply import pack_reply
+from didcomm_v2.peer_did import resolve_peer_did
+from db_utils import add_outbound_message, claim_outbound_message, remove_outbound_message, retry_outbound_message
+import asyncio
+import datetime
+import httpx
 import json
 import os
 import uuid
 
+OUTBOUND_CONCURRENCY = int(os.environ["OUTBOUND_CONCURRENCY"]) if "OUTBOUND_CONCURRENCY" in os.environ else 50
+OUTBOUND_KEEPALIVE = int(os.environ["OUTBOUND_KEEPALIVE"]) if "OUTBOUND_KEEPALIVE" in os.environ else 20
+OUTBOUND_TIMEOUT = float(os.environ["OUTBOUND_TIMEOUT"]) if "OUTBOUND_TIMEOUT" in os.environ else 10.0
+OUTBOUND_MAX_ATTEMPTS = int(os.environ["OUTBOUND_MAX_ATTEMPTS"]) if "OUTBOUND_MAX_ATTEMPTS" in os.environ else 8
+OUTBOUND_BACKOFF_SECONDS = float(os.environ["OUTBOUND_BACKOFF_SECONDS"]) if "OUTBOUND_BACKOFF_SECONDS" in os.environ else 2.0
+OUTBOUND_POLL_SECONDS = 5.0
+HEADERS = {"Content-Type": "application/didcomm-encrypted+json"}
 
+http_client = None
+outbound_wakeup = None
+outbound_tasks = set()
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """ Shared HTTP client, keeps connections alive per host """
+    global http_client
+    if not http_client:
+        http_client = httpx.AsyncClient(
+            timeout=OUTBOUND_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=OUTBOUND_CONCURRENCY,
+                max_keepalive_connections=OUTBOUND_KEEPALIVE
+            )
+        )
+    return http_client
 
 
 async def send_http_msg(packed_msg, to_did: str, from_did: str):
     """ Send a DIDComm message over HTTP """
-    to_did_doc = json.loads(peer_did.resolve_peer_did(to_did))
+    to_did_doc = resolve_peer_did(to_did)
     service_endpoint = to_did_doc["service"][0]["serviceEndpoint"]
 
     if type(service_endpoint) ==  str and service_endpoint.startswith("http"):
@@ -34,18 +58,15 @@ async def send_http_msg(packed_msg, to_did: str, from_did: str):
         
     
 async def send_direct_message(packed_msg, url: str):
-    print("Sending HTTP message")
-    headers = {"Content-Type": "application/didcomm-encrypted+json"}
-    resp = requests.post(url, headers=headers, json = json.loads(packed_msg.packed_msg))
-    print(resp.status_code)
-    # TODO handle errors
+    print("Queueing HTTP message")
+    await queue_outbound_message(url, packed_msg.packed_msg)
 
 async def send_forward_message(packed_msg, to_did: str, forward_did: str):
     # get mediator endpoint
-    forward_did_doc = json.loads(peer_did.resolve_peer_did(forward_did))
+    forward_did_doc = resolve_peer_did(forward_did)
     forward_endpoint = forward_did_doc["service"][0]["serviceEndpoint"]
     public_url = os.environ["PUBLIC_URL"] if "PUBLIC_URL" in os.environ  else "http://127.0.0.1:8000"
-    ephemeral_did = await create_peer_did(1, 1, service_endpoint=public_url)
+    ephemeral_did = await get_peer_did(public_url)
     forward_message = Message(
     id = str(uuid.uuid4()),
         type="https://didcomm.org/routing/2.0/forward",
@@ -55,23 +76,80 @@ async def send_forward_message(packed_msg, to_did: str, forward_did: str):
                 data=AttachmentDataJson(json=json.loads(packed_msg.packed_msg))
             )]
     )
-    forward_message_packed = await pack_encrypted(
-        resolvers_config = ResolversConfig(
-            secrets_resolver = get_secret_resolver(),
-            did_resolver = DIDResolverPeerDID()
-        ),
-        message = forward_message,
-        frm = ephemeral_did,
-        to = forward_did,
-        sign_frm = None,
-        pack_config = PackEncryptedConfig(protect_sender_id=False)
-    )
+    forward_message_packed = await pack_reply(forward_message, ephemeral_did, forward_did)
         
-    print("Sending HTTP forward message")
-    headers = {"Content-Type": "application/didcomm-encrypted+json"}
-    resp = requests.post(forward_endpoint, headers=headers, json = json.loads(forward_message_packed.packed_msg))
-    print(resp.status_code)
-    # TODO handle errors
+    print("Queueing HTTP forward message")
+    await queue_outbound_message(forward_endpoint, forward_message_packed)
+
+
+async def queue_outbound_message(url: str, payload: str):
+    """ Store a message for delivery and wake up the sender """
+    await add_outbound_message(url, payload)
+    if outbound_wakeup:
+        outbound_wakeup.set()
+
+
+def start_outbound_worker():
+    """ Start the background task that delivers queued messages """
+    global outbound_wakeup
+    if not outbound_wakeup:
+        outbound_wakeup = asyncio.Event()
+        outbound_tasks.add(asyncio.create_task(outbound_worker()))
+
+
+async def stop_outbound_worker():
+    for task in list(outbound_tasks):
+        task.cancel()
+    if http_client:
+        await http_client.aclose()
+
+
+async def outbound_worker():
+    slots = asyncio.Semaphore(OUTBOUND_CONCURRENCY)
+    while True:
+        # take a slot first so the lease only starts when the message can be sent right away
+        await slots.acquire()
+        try:
+            # the POST is cut at OUTBOUND_TIMEOUT, the lease leaves the same time again for the DB update
+            message = await claim_outbound_message(OUTBOUND_TIMEOUT * 2)
+        except Exception as ex:
+            print("ERROR: Outbound queue unavailable", ex)
+            message = None
+        if not message:
+            slots.release()
+            outbound_wakeup.clear()
+            try:
+                await asyncio.wait_for(outbound_wakeup.wait(), OUTBOUND_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        task = asyncio.create_task(deliver_outbound_message(message, slots))
+        outbound_tasks.add(task)
+        task.add_done_callback(outbound_tasks.discard)
+
+
+async def deliver_outbound_message(message, slots: asyncio.Semaphore):
+    """ POST a queued message, retrying with exponential backoff on failure """
+    try:
+        try:
+            # httpx timeouts apply to each phase, wait_for bounds the whole request
+            resp = await asyncio.wait_for(
+                get_http_client().post(message["url"], headers=HEADERS, content=message["payload"]),
+                OUTBOUND_TIMEOUT
+            )
+            error = None if resp.status_code < 300 else "HTTP " + str(resp.status_code)
+        except Exception as ex:
+            # timeouts, invalid URLs and any other failure are retried and dead-lettered alike
+            error = repr(ex)
+        if not error:
+            await remove_outbound_message(message["_id"])
+            return
+        print("ERROR: Delivery to", message["url"], "failed:", error)
+        dead = message["attempts"] >= OUTBOUND_MAX_ATTEMPTS
+        next_attempt = datetime.datetime.now().timestamp() + OUTBOUND_BACKOFF_SECONDS * 2 ** (message["attempts"] - 1)
+        await retry_outbound_message(message["_id"], next_attempt, error, dead)
+    finally:
+        slots.release()
     
 
 
@@ -0,0 +1,82 @@
+""" Group commit of forwarded messages """
+import asyncio
+import os
+from pymongo.errors import BulkWriteError
+from db_utils import add_message, add_messages, message_document
+
+# messages stored in one bulk insert, 0 or 1 stores every message on its own
+FORWARD_BATCH_SIZE = int(os.environ["FORWARD_BATCH_SIZE"]) if "FORWARD_BATCH_SIZE" in os.environ else 0
+FORWARD_BATCH_MS = float(os.environ["FORWARD_BATCH_MS"]) if "FORWARD_BATCH_MS" in os.environ else 5.0
+
+
+class WriteBuffer:
+    """ Coalesces the messages of concurrent forwards into bulk inserts.
+        A batch is written when it is full or FORWARD_BATCH_MS after its first message,
+        each caller waits until the batch holding its message is acknowledged """
+    def __init__(self, size: int = FORWARD_BATCH_SIZE, delay_ms: float = FORWARD_BATCH_MS):
+        self.size = size
+        self.delay = delay_ms / 1000
+        self.pending = []
+        self.timer = None
+        self.tasks = set()
+
+    async def add(self, document):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((document, future))
+        if len(self.pending) >= self.size:
+            self.flush()
+        elif not self.timer:
+            self.timer = asyncio.get_running_loop().call_later(self.delay, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        task = asyncio.create_task(self.write(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def write(self, batch):
+        failed = {}
+        try:
+            await add_messages([document for document, _ in batch])
+        except BulkWriteError as ex:
+            if ex.details.get("writeConcernErrors"):
+                # the inserts were not confirmed durable, none of the senders gets an acknowledgement
+                failed = {index: ex for index in range(len(batch))}
+            else:
+                for error in ex.details["writeErrors"]:
+                    failed[error["index"]] = ex
+        except Exception as ex:
+            failed = {index: ex for index in range(len(batch))}
+        for index, (document, future) in enumerate(batch):
+            if future.done():
+                continue
+            if index in failed:
+                future.set_exception(failed[index])
+            else:
+                future.set_result(document["_id"])
+
+    async def close(self):
+        """ Write the pending messages and wait for the batches in flight """
+        self.flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+write_buffer = WriteBuffer()
+
+
+async def store_message(recipient_key: str, attachment, due_time=None, expires_time=None):
+    """ Store a forwarded message, return its id once it is acknowledged by the database """
+    if FORWARD_BATCH_SIZE <= 1:
+        return await add_message(recipient_key, attachment, due_time, expires_time)
+    return await write_buffer.add(message_document(recipient_key, attachment, due_time, expires_time))
+
+
+async def flush_write_buffer():
+    await write_buffer.close()
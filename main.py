@@ -1,19 +1,25 @@
 """ DIDComm v2 Mediator """
 import datetime
 import uvicorn
-from fastapi import Request, FastAPI, HTTPException
+from fastapi import Request, FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.responses import FileResponse, Response, RedirectResponse, HTMLResponse
 from fastapi.middleware.cors import CORSMiddleware
-from didcomm.unpack import unpack
-from didcomm.common.resolvers import ResolversConfig
+from didcomm_v2.crypto_pool import unpack, recipient_kids, CryptoQueueFull
 from didcomm_v2.peer_did import create_peer_did
-from didcomm_v2.peer_did import get_secret_resolver
-from didcomm_v2.peer_did import DIDResolverPeerDID
+from didcomm_v2.peer_did import get_secret_resolver, SECRETS_CACHE_SIZE
+from didcomm_v2.pack_reply import get_resolvers_config
 from didcomm_v2.message_dispatch import message_dispatch
+from didcomm_v2.peer_did_pool import get_pool
+from didcomm_v2.send_http_message import start_outbound_worker, stop_outbound_worker
+from didcomm_v2.notification_bus import start_notification_bus, stop_notification_bus
+from didcomm_v2.write_buffer import flush_write_buffer
+from didcomm_v2.message_expiry import start_expiry_sweeper, stop_expiry_sweeper
+from didcomm_v2.kid_refresh import start_kid_refresh, stop_kid_refresh
+from didcomm_v2.live_delivery import LiveSession, current_session, disable_live_delivery
 from protocols.oob import create_oob
-from db_utils import get_oob_did, store_oob_did, get_short_url
+from protocols.routing import QuotaExceeded
+from db_utils import get_oob_did, store_oob_did, get_short_url, get_routing_dids, migrate_keylists, migrate_key_counts, migrate_queue_stats, create_indexes
 import os
-import json
 
 app = FastAPI()
 SERVER_IP = "0.0.0.0"
@@ -33,16 +39,30 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(CryptoQueueFull)
+async def crypto_queue_full_handler(request: Request, ex: CryptoQueueFull):
+    """ Crypto pool saturated, ask the sender to retry later """
+    return Response(str(ex), status_code=503)
+
+@app.exception_handler(QuotaExceeded)
+async def quota_exceeded_handler(request: Request, ex: QuotaExceeded):
+    """ Recipient queue full, ask the sender to retry later """
+    return Response(str(ex), status_code=429)
+
 @app.on_event("startup")
 async def startup():
     """ Server start up """
     print("Server Start up")
-    oob = get_oob_did()
+    await create_indexes()
+    await migrate_keylists()
+    await migrate_key_counts()
+    await migrate_queue_stats()
+    oob = await get_oob_did()
     print(oob)
     if not oob or os.environ["ROTATE_OOB"]=="1":
         print("Generating OOB")
         app.state.oob_did = await create_peer_did(1, 1, service_endpoint=PUBLIC_URL)
-        store_oob_did({
+        await store_oob_did({
           "did": app.state.oob_did,
           "date": int(datetime.datetime.now().timestamp())*1000,
           "url": PUBLIC_URL
@@ -51,22 +71,42 @@ async def startup():
         app.state.oob_did = oob["did"]
 
     print(app.state.oob_did)
-    app.state.oob_url = create_oob(app.state.oob_did, PUBLIC_URL)
+    await secrets_resolver.warm_up([app.state.oob_did] + await get_routing_dids(SECRETS_CACHE_SIZE // 2))
+    await secrets_resolver.load_kids()
+    start_kid_refresh()
+    get_pool(PUBLIC_URL).start()
+    start_outbound_worker()
+    start_notification_bus()
+    start_expiry_sweeper()
+    app.state.oob_url = await create_oob(app.state.oob_did, PUBLIC_URL)
 
     print(app.state.oob_url)
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    """ Server shut down """
+    await stop_outbound_worker()
+    await stop_notification_bus()
+    await stop_expiry_sweeper()
+    await stop_kid_refresh()
+    await flush_write_buffer()
+
+
 @app.post("/", status_code=202)
 async def receive_message(request: Request):
     """ Endpoint for receiving all DIDComm messages """
     try:
+        packed_msg = await request.json()
+        # reject messages for keys this mediator doesn't hold before any crypto work
+        if not await secrets_resolver.has_kids(recipient_kids(packed_msg)):
+            raise ValueError("No recipient key of this mediator")
         unpack_msg = await unpack(
-            resolvers_config=ResolversConfig(
-                secrets_resolver=secrets_resolver,
-                did_resolver=DIDResolverPeerDID()
-            ),
-            packed_msg=await request.json()
+            resolvers_config=get_resolvers_config(),
+            packed_msg=packed_msg
         )
+    except CryptoQueueFull as ex:
+        raise HTTPException(status_code=503, detail=str(ex))
     # FIXME REPORT PROBLEM
     except Exception as ex:
         print(ex)
@@ -75,7 +115,7 @@ async def receive_message(request: Request):
         print(unpack_msg.message.type)
         resp = await message_dispatch(unpack_msg)
         if resp:
-            return json.loads(resp)
+            return Response(resp, status_code=202, media_type="application/didcomm-encrypted+json")
         else:
             return
         
@@ -88,6 +128,41 @@ async def receive_message(request: Request):
             #   print("send in another thread")
 
 
+@app.websocket("/ws")
+async def receive_websocket_message(websocket: WebSocket):
+    """ WebSocket endpoint for DIDComm messages, supports Pickup live delivery """
+    await websocket.accept()
+    session = LiveSession(websocket)
+    current_session.set(session)
+    try:
+        while True:
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                break
+            # a failing message is logged and skipped, the socket stays open for the next ones
+            try:
+                packed_msg = frame["text"] if frame.get("text") is not None else frame["bytes"].decode("utf-8")
+                if not await secrets_resolver.has_kids(recipient_kids(packed_msg)):
+                    raise ValueError("No recipient key of this mediator")
+                unpack_msg = await unpack(
+                    resolvers_config=get_resolvers_config(),
+                    packed_msg=packed_msg
+                )
+                print(unpack_msg.message.type)
+                resp = await message_dispatch(unpack_msg)
+                if resp:
+                    await session.send(resp)
+            except WebSocketDisconnect:
+                raise
+            except Exception as ex:
+                print("ERROR: WebSocket message failed", repr(ex))
+                continue
+    except WebSocketDisconnect:
+        pass
+    finally:
+        disable_live_delivery(session)
+
+
 @app.get("/oob_qrcode")
 async def get_oob_qrcode():
     ''' Return OOB QR Code image '''
@@ -108,7 +183,7 @@ async def get_oob_url():
 async def redirect_shortened_url(_oobid):
     ''' Redirect short URLs '''
     print(_oobid)
-    short_url_reg = get_short_url(_oobid)
+    short_url_reg = await get_short_url(_oobid)
     if short_url_reg and (short_url_reg["expires_time"] > int(datetime.datetime.now().timestamp()*1000) or short_url_reg["expires_time"] == 0):
         print(short_url_reg["long_url"])
         return RedirectResponse(short_url_reg["long_url"], 301)
@@ -119,7 +194,7 @@ async def redirect_shortened_url(_oobid):
 async def redirect_shortened_url(_oobid):
     ''' Redirect short URLs '''
     print(_oobid)
-    short_url_reg = get_short_url(_oobid)
+    short_url_reg = await get_short_url(_oobid)
     if short_url_reg and short_url_reg["expires_time"] > int(datetime.datetime.now().timestamp()*1000):
         print(short_url_reg["long_url"])
         return RedirectResponse(short_url_reg["long_url"], 301)
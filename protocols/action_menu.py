@@ -1,23 +1,16 @@
 """ Action Menu 2.0 Protocol """
 from didcomm.message import Message, FromPrior
 import uuid
-from didcomm.pack_encrypted import pack_encrypted, PackEncryptedConfig, PackEncryptedResult
-from didcomm.common.resolvers import ResolversConfig
+from didcomm_v2.pack_reply import pack_reply
 from didcomm.unpack import UnpackResult
-from didcomm_v2.peer_did import get_secret_resolver
-from didcomm_v2.peer_did import DIDResolverPeerDID
 from protocols.question_answer import submit_question
+from didcomm_v2.protocol_router import register
 import datetime
 import os
 import urllib.parse
 import requests
 
-async def process_action_menu_message(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
-    if unpack_msg.message.type == "https://didcomm.org/action-menu/2.0/menu-request":
-            return await process_menu_request(unpack_msg, remote_did, local_did, from_prior)
-    elif unpack_msg.message.type == "https://didcomm.org/action-menu/2.0/perform":
-            return await process_perform(unpack_msg, remote_did, local_did, from_prior)
-
+@register("https://didcomm.org/action-menu", "2.0", "menu-request")
 async def process_menu_request(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
 
     # TODO GET MENU FROM DB
@@ -83,19 +76,9 @@ async def process_menu_request(unpack_msg: UnpackResult, remote_did, local_did,
         body=menu,
         from_prior = from_prior
     )
-    response_packed = await pack_encrypted(
-        resolvers_config=ResolversConfig(
-            secrets_resolver=get_secret_resolver(),
-            did_resolver=DIDResolverPeerDID()
-        ),
-        message=response_message,
-        frm=local_did,
-        to=remote_did,
-        sign_frm=None,
-        pack_config=PackEncryptedConfig(protect_sender_id=False)
-    )
-    return response_packed.packed_msg
+    return await pack_reply(response_message, local_did, remote_did)
 
+@register("https://didcomm.org/action-menu", "2.0", "perform")
 async def process_perform(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
     # TODO PERFROM ACTION FROM DB OR EXTERNAL
     perform_action = unpack_msg.message.body["name"]
@@ -110,18 +93,7 @@ async def process_perform(unpack_msg: UnpackResult, remote_did, local_did, from_
                         }],
             from_prior = from_prior
         )
-        response_packed = await pack_encrypted(
-            resolvers_config=ResolversConfig(
-                secrets_resolver=get_secret_resolver(),
-                did_resolver=DIDResolverPeerDID()
-            ),
-            message=response_message,
-            frm=local_did,
-            to=remote_did,
-            sign_frm=None,
-            pack_config=PackEncryptedConfig(protect_sender_id=False)
-        )
-        return response_packed.packed_msg
+        return await pack_reply(response_message, local_did, remote_did)
     elif perform_action == "ask-me-example":
         question = urllib.parse.quote(unpack_msg.message.body["params"]["question"])
         if "WOLFRAM_ALPHA_API_ID" in os.environ:
@@ -137,18 +109,7 @@ async def process_perform(unpack_msg: UnpackResult, remote_did, local_did, from_
                         }],
             from_prior = from_prior
         )
-        response_packed = await pack_encrypted(
-            resolvers_config=ResolversConfig(
-                secrets_resolver=get_secret_resolver(),
-                did_resolver=DIDResolverPeerDID()
-            ),
-            message=response_message,
-            frm=local_did,
-            to=remote_did,
-            sign_frm=None,
-            pack_config=PackEncryptedConfig(protect_sender_id=False)
-        )
-        return response_packed.packed_msg
+        return await pack_reply(response_message, local_did, remote_did)
     elif perform_action == "trigger-questionanswer":
         await submit_question()
     else: 
@@ -1,12 +1,10 @@
 """ Discover Features 2.0 protocol"""
 from didcomm.message import Message, FromPrior
 import uuid
-from didcomm.pack_encrypted import pack_encrypted, PackEncryptedConfig, PackEncryptedResult
-from didcomm.common.resolvers import ResolversConfig
+from didcomm_v2.pack_reply import pack_reply
 from didcomm.unpack import UnpackResult
-from didcomm_v2.peer_did import get_secret_resolver
-from didcomm_v2.peer_did import DIDResolverPeerDID
 from didcomm_v2.send_http_message import send_http_msg
+from didcomm_v2.protocol_router import register
 
 import re
 supported_protocols = [
@@ -20,6 +18,7 @@ supported_protocols = [
     "https://didcomm.org/shorten-url/1.0/"
 ]
 
+@register("https://didcomm.org/discover-features", "2.0", "queries")
 async def process_discover_queries(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
     """ Response to Queries message. Only protocols queries are supported. No roles are not reported """
     queries = unpack_msg.message.body["queries"]
@@ -40,16 +39,5 @@ async def process_discover_queries(unpack_msg: UnpackResult, remote_did, local_d
         body={"disclosures": disclosures},
         from_prior = from_prior
     )
-    response_packed = await pack_encrypted(
-        resolvers_config=ResolversConfig(
-            secrets_resolver=get_secret_resolver(),
-            did_resolver=DIDResolverPeerDID()
-        ),
-        message=response_message,
-        frm=local_did,
-        to=remote_did,
-        sign_frm=None,
-        pack_config=PackEncryptedConfig(protect_sender_id=False)
-    )
-    return response_packed.packed_msg
+    return await pack_reply(response_message, local_did, remote_did)
     
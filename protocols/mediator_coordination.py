@@ -1,51 +1,35 @@
 """ Mediator Coordination Protocol """
 from didcomm.message import Message, FromPrior
 import uuid
-from didcomm.pack_encrypted import pack_encrypted, PackEncryptedConfig, PackEncryptedResult
-from didcomm.common.resolvers import ResolversConfig
+from didcomm_v2.pack_reply import pack_reply
 from didcomm.unpack import UnpackResult
 from importlib_metadata import metadata
-from didcomm_v2.peer_did import get_secret_resolver
-from didcomm_v2.peer_did import DIDResolverPeerDID
-from didcomm_v2.peer_did import create_peer_did
-from db_utils import get_connection, add_mediation, update_keys
+from didcomm_v2.peer_did_pool import get_peer_did
+from didcomm_v2.protocol_router import register
+from db_utils import get_connection, add_mediation, update_keys, get_keylist
+import base64
+import json
 import os
 
+KEYLIST_MAX_PAGE_SIZE = int(os.environ["KEYLIST_MAX_PAGE_SIZE"]) if "KEYLIST_MAX_PAGE_SIZE" in os.environ else 1000
 
-async def process_mediator_message(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
-    """ Process Mediator Coordinator messages """
-    if unpack_msg.message.type == "https://didcomm.org/coordinate-mediation/2.0/mediate-request":
-            return await process_mediate_request(unpack_msg, remote_did, local_did, from_prior)
-    elif unpack_msg.message.type == "https://didcomm.org/coordinate-mediation/2.0/keylist-update":
-            return await process_keylist_update(unpack_msg, remote_did, local_did, from_prior)
-    elif unpack_msg.message.type == "https://didcomm.org/coordinate-mediation/2.0/keylist-query":
-            return await process_keylist_query(unpack_msg, remote_did, local_did, from_prior)
 
+@register("https://didcomm.org/coordinate-mediation", "2.0", "mediate-request")
 async def process_mediate_request(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
     # check if already a connection and deny
-    if "isMediation" in get_connection(remote_did) and get_connection(remote_did)["isMediation"]:
+    connection = await get_connection(remote_did)
+    if connection.is_mediation:
         response_message = Message(
         id=str(uuid.uuid4()),
         type="https://didcomm.org/coordinate-mediation/2.0/mediate-deny",
         body={},
         from_prior = from_prior
         )
-        response_packed = await pack_encrypted(
-            resolvers_config=ResolversConfig(
-                secrets_resolver=get_secret_resolver(),
-                did_resolver=DIDResolverPeerDID()
-            ),
-            message=response_message,
-            frm=local_did,
-            to=remote_did,
-            sign_frm=None,
-            pack_config=PackEncryptedConfig(protect_sender_id=False)
-        )
-        return response_packed.packed_msg
+        return await pack_reply(response_message, local_did, remote_did)
 
-    routing_did = await create_peer_did(1, 1, service_endpoint=os.environ["PUBLIC_URL"])
+    routing_did = await get_peer_did(os.environ["PUBLIC_URL"])
     endpoint = os.environ["PUBLIC_URL"]
-    add_mediation(remote_did, routing_did, endpoint)
+    await add_mediation(remote_did, routing_did, endpoint)
     response_message = Message(
         id=str(uuid.uuid4()),
         type="https://didcomm.org/coordinate-mediation/2.0/mediate-grant",
@@ -54,21 +38,11 @@ async def process_mediate_request(unpack_msg: UnpackResult, remote_did, local_di
         },
         from_prior = from_prior
     )
-    response_packed = await pack_encrypted(
-        resolvers_config=ResolversConfig(
-            secrets_resolver=get_secret_resolver(),
-            did_resolver=DIDResolverPeerDID()
-        ),
-        message=response_message,
-        frm=local_did,
-        to=remote_did,
-        sign_frm=None,
-        pack_config=PackEncryptedConfig(protect_sender_id=False)
-    )
-    return response_packed.packed_msg
+    return await pack_reply(response_message, local_did, remote_did)
 
+@register("https://didcomm.org/coordinate-mediation", "2.0", "keylist-update")
 async def process_keylist_update(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
-    updated = update_keys(remote_did, unpack_msg.message.body["updates"])
+    updated = await update_keys(remote_did, unpack_msg.message.body["updates"])
 
     response_message = Message(
         id=str(uuid.uuid4()),
@@ -78,40 +52,43 @@ async def process_keylist_update(unpack_msg: UnpackResult, remote_did, local_did
         },
         from_prior = from_prior
     )
-    response_packed = await pack_encrypted(
-        resolvers_config=ResolversConfig(
-            secrets_resolver=get_secret_resolver(),
-            did_resolver=DIDResolverPeerDID()
-        ),
-        message=response_message,
-        frm=local_did,
-        to=remote_did,
-        sign_frm=None,
-        pack_config=PackEncryptedConfig(protect_sender_id=False)
-    )
-    return response_packed.packed_msg
+    return await pack_reply(response_message, local_did, remote_did)
 
+@register("https://didcomm.org/coordinate-mediation", "2.0", "keylist-query")
 async def process_keylist_query(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
-    # TODO ADD PAGINATION
-    connection = get_connection(remote_did)
-    keylist = connection["keylist"] if "keylist" in connection else []
+    paginate = unpack_msg.message.body["paginate"] if "paginate" in unpack_msg.message.body else {}
+    offset = max(int(paginate["offset"]), 0) if "offset" in paginate else 0
+    limit = min(max(int(paginate["limit"]), 1), KEYLIST_MAX_PAGE_SIZE) if "limit" in paginate else KEYLIST_MAX_PAGE_SIZE
+    # the cursor of the previous page continues on the index after its last key, without skipping
+    after = None
+    if "cursor" in paginate:
+        offset, after = decode_cursor(paginate["cursor"])
+    keylist, total = await get_keylist(remote_did, offset, limit, after)
+    remaining = max(total - offset - len(keylist), 0)
+    pagination = {
+        "count": len(keylist),
+        "offset": offset,
+        "remaining": remaining
+    }
+    if keylist and remaining:
+        pagination["cursor"] = encode_cursor(offset + len(keylist), keylist[-1])
     response_message = Message(
         id=str(uuid.uuid4()),
         type="https://didcomm.org/coordinate-mediation/2.0/keylist",
         body={
-            "keys": [{"recipient_did": k} for k in keylist]
+            "keys": [{"recipient_did": k} for k in keylist],
+            "pagination": pagination
         },
         from_prior = from_prior
     )
-    response_packed = await pack_encrypted(
-        resolvers_config=ResolversConfig(
-            secrets_resolver=get_secret_resolver(),
-            did_resolver=DIDResolverPeerDID()
-        ),
-        message=response_message,
-        frm=local_did,
-        to=remote_did,
-        sign_frm=None,
-        pack_config=PackEncryptedConfig(protect_sender_id=False)
-    )
-    return response_packed.packed_msg
\ No newline at end of file
+    return await pack_reply(response_message, local_did, remote_did)
+
+
+def encode_cursor(offset, after):
+    """ Opaque keylist-query cursor: offset of the next page and the last key of this one """
+    return base64.urlsafe_b64encode(json.dumps([offset, after]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    offset, after = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return max(int(offset), 0), str(after)
@@ -8,7 +8,7 @@ import os
 import datetime
 
 
-def create_oob(did, url):
+async def create_oob(did, url):
     """ Create Out of band Message """
     oob_mesage = {
         "type": "https://didcomm.org/out-of-band/2.0/invitation",
@@ -36,7 +36,7 @@ def create_oob(did, url):
     date = int(datetime.datetime.now().timestamp())*1000
     expires_time = 0
     short_url = url + "/qr?_oobid=" + oobid
-    store_short_url(
+    await store_short_url(
             {
                 "date": date,
                 "expires_time": expires_time,
@@ -1,27 +1,36 @@
 """ Pickup Protocol """
 from didcomm.message import Message, FromPrior
 import uuid
-from didcomm.pack_encrypted import pack_encrypted, PackEncryptedConfig, PackEncryptedResult
-from didcomm.common.resolvers import ResolversConfig
+from didcomm_v2.pack_reply import pack_reply
 from didcomm.unpack import UnpackResult
-from didcomm_v2.peer_did import get_secret_resolver
-from didcomm_v2.peer_did import DIDResolverPeerDID
 from didcomm.message import Attachment, AttachmentDataJson
-from db_utils import get_message_status, get_messages, remove_messages
+from didcomm_v2.protocol_router import register
+from didcomm_v2.live_delivery import get_current_session, enable_live_delivery, disable_live_delivery, is_live
+from db_utils import get_connection, get_message_status, claim_next_messages, remove_messages, load_attachment
+import datetime
+import os
 
+PICKUP_MAX_BYTES = int(os.environ["PICKUP_MAX_BYTES"]) if "PICKUP_MAX_BYTES" in os.environ else 1048576
 
-async def process_pickup_message(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
-    """ Process Pickup messages """
-    if unpack_msg.message.type == "https://didcomm.org/messagepickup/3.0/status-request":
-            return await process_status_request(unpack_msg, remote_did, local_did, from_prior)
-    elif unpack_msg.message.type == "https://didcomm.org/messagepickup/3.0/delivery-request":
-            return await process_delivery_request(unpack_msg, remote_did, local_did, from_prior)
-    elif unpack_msg.message.type == "https://didcomm.org/messagepickup/3.0/messages-received":
-            return await process_message_received(unpack_msg, remote_did, local_did, from_prior)
-    elif unpack_msg.message.type == "https://didcomm.org/messagepickup/3.0/live-delivery-change":
-            return await process_livedelivery_change(unpack_msg, remote_did, local_did, from_prior)
 
+def queue_status(stats):
+    """ Status fields of the queue statistics, including the optional ones """
+    status = {
+        "message_count": stats["count"],
+        "total_bytes": stats["bytes"]
+    }
+    if stats["count"] > 0 and "oldest_received_time" in stats:
+        status["longest_waited_seconds"] = max(int(datetime.datetime.now().timestamp()) - stats["oldest_received_time"], 0)
+        status["newest_received_time"] = format_time(stats["newest_received_time"])
+        status["oldest_received_time"] = format_time(stats["oldest_received_time"])
+    return status
 
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%SZ")
+
+
+@register("https://didcomm.org/messagepickup", "3.0", "status-request")
 async def process_status_request(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
     if  "recipient_key" in unpack_msg.message.body:
          recipient_key =  unpack_msg.message.body["recipient_key"]
@@ -30,59 +39,42 @@ async def process_status_request(unpack_msg: UnpackResult, remote_did, local_did
     else:
         recipient_key = None
           
-    count = get_message_status(remote_did, recipient_key)
-    # TODO add optional info 
+    stats = await get_message_status(remote_did, recipient_key)
     response_message = Message(
         id=str(uuid.uuid4()),
         type="https://didcomm.org/messagepickup/3.0/status",
         body={
                 "recipient_key": recipient_key,
-                "message_count": count,
-                # "longest_waited_seconds": 3600,
-                # "newest_received_time": "2019-05-01 12:00:00Z",
-                # "oldest_received_time": "2019-05-01 12:00:01Z",
-                # "total_bytes": 8096,
-                "live_delivery": False
+                **queue_status(stats),
+                "live_delivery": is_live(get_current_session())
         },
         from_prior = from_prior
     )
-    response_packed = await pack_encrypted(
-        resolvers_config=ResolversConfig(
-            secrets_resolver=get_secret_resolver(),
-            did_resolver=DIDResolverPeerDID()
-        ),
-        message=response_message,
-        frm=local_did,
-        to=remote_did,
-        sign_frm=None,
-        pack_config=PackEncryptedConfig(protect_sender_id=False)
-    )
-    return response_packed.packed_msg
+    return await pack_reply(response_message, local_did, remote_did)
 
 
+@register("https://didcomm.org/messagepickup", "3.0", "delivery-request")
 async def process_delivery_request(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
     recipient_key =  unpack_msg.message.body["recipient_did"] if "recipient_did" in unpack_msg.message.body else None
     limit = unpack_msg.message.body["limit"] 
-    messages = get_messages(remote_did, recipient_key,int(limit))
-    if len(list(messages)) == 0:
+    attachments = []
+    for message in await claim_next_messages(remote_did, recipient_key, int(limit), PICKUP_MAX_BYTES):
+        attachments.append(Attachment(
+            id=str(message["_id"]),
+            data=AttachmentDataJson(json=await load_attachment(message))
+        ))
+    if len(attachments) == 0:
         response_message = Message(
         id=str(uuid.uuid4()),
         type="https://didcomm.org/messagepickup/3.0/status",
         body={
                 "recipient_key": recipient_key,
-                "message_count": 0,
-                "live_delivery": False
+                **queue_status(await get_message_status(remote_did, recipient_key)),
+                "live_delivery": is_live(get_current_session())
         },
         from_prior = from_prior
     )
     else:
-        attachments = []
-        for att in messages:
-            attachments.append(Attachment(
-                id=str(att["_id"]),
-                data=AttachmentDataJson(json=att["attachment"]
-                )
-        ))
         # TODO add optional info 
         response_message = Message(
             id=str(uuid.uuid4()),
@@ -94,61 +86,53 @@ async def process_delivery_request(unpack_msg: UnpackResult, remote_did, local_d
             attachments = attachments,
             from_prior = from_prior
         )
-    response_packed = await pack_encrypted(
-        resolvers_config=ResolversConfig(
-            secrets_resolver=get_secret_resolver(),
-            did_resolver=DIDResolverPeerDID()
-        ),
-        message=response_message,
-        frm=local_did,
-        to=remote_did,
-        sign_frm=None,
-        pack_config=PackEncryptedConfig(protect_sender_id=False)
-    )
-    return response_packed.packed_msg
+    return await pack_reply(response_message, local_did, remote_did)
 
 
+@register("https://didcomm.org/messagepickup", "3.0", "messages-received")
 async def process_message_received(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
     message_id_list =  unpack_msg.message.body["message_id_list"]
     recipient_key =  unpack_msg.message.body["recipient_key"] if "recipient_key" in unpack_msg.message.body else None
     # remove messages info in DB
-    remove_messages(remote_did, message_id_list)
-    count = get_message_status(remote_did, recipient_key)
+    stats = await remove_messages(remote_did, message_id_list, recipient_key)
 
     response_message = Message(
     id=str(uuid.uuid4()),
     type="https://didcomm.org/messagepickup/3.0/status",
     body={
-            "message_count": count,
-            "live_delivery": False,
-            # "longest_waited_seconds": 3600,
-            # "newest_received_time": "2019-05-01 12:00:00Z",
-            # "oldest_received_time": "2019-05-01 12:00:01Z",
-            # "total_bytes": 8096,
-            "live_delivery": False
+            **queue_status(stats),
+            "live_delivery": is_live(get_current_session())
     },
     from_prior = from_prior
     )
  
-    response_packed = await pack_encrypted(
-        resolvers_config=ResolversConfig(
-            secrets_resolver=get_secret_resolver(),
-            did_resolver=DIDResolverPeerDID()
-        ),
-        message=response_message,
-        frm=local_did,
-        to=remote_did,
-        sign_frm=None,
-        pack_config=PackEncryptedConfig(protect_sender_id=False)
-    )
-    return response_packed.packed_msg
+    return await pack_reply(response_message, local_did, remote_did)
 
 
 
+@register("https://didcomm.org/messagepickup", "3.0", "live-delivery-change")
 async def process_livedelivery_change(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
-    if "live_delivery" in unpack_msg.message.body and unpack_msg.message.body["live_delivery"]:
-
-
+    live_delivery = "live_delivery" in unpack_msg.message.body and unpack_msg.message.body["live_delivery"]
+    session = get_current_session()
+    if session:
+        # live delivery is only possible on a WebSocket
+        if live_delivery:
+            connection = await get_connection(remote_did)
+            enable_live_delivery(session, connection.id, remote_did, local_did)
+        else:
+            disable_live_delivery(session)
+        response_message = Message(
+            id=str(uuid.uuid4()),
+            thid=unpack_msg.message.id if not unpack_msg.message.thid else unpack_msg.message.thid,
+            type="https://didcomm.org/messagepickup/3.0/status",
+            body={
+                    **queue_status(await get_message_status(remote_did, None)),
+                    "live_delivery": is_live(session)
+            },
+            from_prior = from_prior
+        )
+        return await pack_reply(response_message, local_did, remote_did)
+    elif live_delivery:
         response_message = Message(
             id=str(uuid.uuid4()),
             pthid= unpack_msg.message.id if not unpack_msg.message.thid else unpack_msg.message.thid,
@@ -160,15 +144,4 @@ async def process_livedelivery_change(unpack_msg: UnpackResult, remote_did, loca
             },
             from_prior = from_prior
         )
-        response_packed = await pack_encrypted(
-            resolvers_config=ResolversConfig(
-                secrets_resolver=get_secret_resolver(),
-                did_resolver=DIDResolverPeerDID()
-            ),
-            message=response_message,
-            frm=local_did,
-            to=remote_did,
-            sign_frm=None,
-            pack_config=PackEncryptedConfig(protect_sender_id=False)
-        )
-        return response_packed.packed_msg
\ No newline at end of file
+        return await pack_reply(response_message, local_did, remote_did)
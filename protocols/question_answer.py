@@ -1,16 +1,15 @@
 """ Basic Message Protocol 2.0 """
 from didcomm.message import Message, FromPrior
 import uuid
-from didcomm.pack_encrypted import pack_encrypted, PackEncryptedConfig, PackEncryptedResult
-from didcomm.common.resolvers import ResolversConfig
+from didcomm_v2.pack_reply import pack_reply
 from didcomm.unpack import UnpackResult
 from importlib_metadata import metadata
-from didcomm_v2.peer_did import get_secret_resolver
-from didcomm_v2.peer_did import DIDResolverPeerDID
+from didcomm_v2.protocol_router import register
 import datetime
 
 
 
+@register("https://didcomm.org/questionanswer", "2.0", "answer")
 async def process_answer(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
     print(unpack_msg.message.body)
 
@@ -39,15 +38,4 @@ async def submit_question(unpack_msg: UnpackResult, remote_did, local_did, from_
             "expires_time": int(datetime.datetime.now().timestamp() + 2 * 60) 
         }
     )
-    response_packed = await pack_encrypted(
-        resolvers_config=ResolversConfig(
-            secrets_resolver=get_secret_resolver(),
-            did_resolver=DIDResolverPeerDID()
-        ),
-        message=response_message,
-        frm=local_did,
-        to=remote_did,
-        sign_frm=None,
-        pack_config=PackEncryptedConfig(protect_sender_id=False)
-    )
-    return response_packed.packed_msg
+    return await pack_reply(response_message, local_did, remote_did)
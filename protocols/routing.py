@@ -1,46 +1,98 @@
 """ Routing Protocol """
 from didcomm.message import Message, FromPrior
+import asyncio
+import datetime
+import json
+import os
 import uuid
-from didcomm.pack_encrypted import pack_encrypted, PackEncryptedConfig, PackEncryptedResult
-from didcomm.common.resolvers import ResolversConfig
 from didcomm.unpack import UnpackResult
-from importlib_metadata import metadata
-from didcomm_v2.peer_did import get_secret_resolver
-from didcomm_v2.peer_did import DIDResolverPeerDID
-from db_utils import add_message
+from didcomm_v2.pack_reply import pack_reply
+from didcomm_v2.protocol_router import register
+from didcomm_v2.notification_bus import publish
+from didcomm_v2.write_buffer import store_message
+from db_utils import get_queue_stats
 
+# max messages and bytes queued for a recipient key and for all the keys of a connection, 0 is unlimited
+QUEUE_MAX_MESSAGES = int(os.environ["QUEUE_MAX_MESSAGES"]) if "QUEUE_MAX_MESSAGES" in os.environ else 0
+QUEUE_MAX_BYTES = int(os.environ["QUEUE_MAX_BYTES"]) if "QUEUE_MAX_BYTES" in os.environ else 0
+CONNECTION_MAX_MESSAGES = int(os.environ["CONNECTION_MAX_MESSAGES"]) if "CONNECTION_MAX_MESSAGES" in os.environ else 0
+CONNECTION_MAX_BYTES = int(os.environ["CONNECTION_MAX_BYTES"]) if "CONNECTION_MAX_BYTES" in os.environ else 0
 
+
+class QuotaExceeded(Exception):
+    """ Forward refused because the recipient queue is full and the sender is anonymous """
+
+
+def get_custom_header(message, name):
+    for header in message.custom_headers or []:
+        if name in header:
+            return header[name]
+    return None
+
+
+@register("https://didcomm.org/routing", "2.0", "forward", requires_connection=False)
 async def process_forward_message(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
-    # TODO REMOVE COMMENT AND FIX IF SENTENCE
-    # check if comply with headers
-    # if unpack_msg.message.expires_time or "delay_milli" in unpack_msg.message.custom_headers:
-    #     #report problem
-    #     response_message = Message(
-    #             id=str(uuid.uuid4()),
-    #             pthid= unpack_msg.message.id if not unpack_msg.message.thid else unpack_msg.message.thid,
-    #             type="https://didcomm.org/report-problem/2.0/problem-report",
-    #             ack=unpack_msg.message.id,
-    #             body={
-    #                     "code": "e.m.header-not-supported",
-    #                     "comment": "expiry time or delay not supported"
-    #             },
-    #             from_prior = from_prior
-    #         )
-    
-    #     response_packed = await pack_encrypted(
-    #         resolvers_config=ResolversConfig(
-    #             secrets_resolver=get_secret_resolver(),
-    #             did_resolver=DIDResolverPeerDID()
-    #         ),
-    #         message=response_message,
-    #         frm=local_did,
-    #         to=remote_did,
-    #         sign_frm=None,
-    #         pack_config=PackEncryptedConfig(protect_sender_id=False)
-    #     )
-    #     return response_packed.packed_msg
-    
+    quota_error = await check_quota(unpack_msg)
+    if quota_error:
+        return await process_quota_exceeded(unpack_msg, quota_error)
+
+    now = datetime.datetime.now().timestamp()
+    # expires_time of the forward is kept with the queued messages, which are dropped once expired
+    expires_time = unpack_msg.message.expires_time
+    if expires_time and expires_time <= now:
+        print("Forward expired, message dropped")
+        return
+    # delay_milli hides the messages from pickup until due
+    delay_milli = get_custom_header(unpack_msg.message, "delay_milli")
+    due_time = int(now + int(delay_milli) / 1000) if delay_milli and int(delay_milli) > 0 else None
+
     # STORE MESSAGES
-    for attachment in unpack_msg.message.attachments:
-        recipient_key = unpack_msg.message.body["next"]
-        add_message(recipient_key, attachment.data.json)
+    recipient_key = unpack_msg.message.body["next"]
+    message_ids = await asyncio.gather(*[
+        store_message(recipient_key, attachment.data.json, due_time, expires_time)
+        for attachment in unpack_msg.message.attachments
+    ])
+    if due_time:
+        return
+    for attachment, message_id in zip(unpack_msg.message.attachments, message_ids):
+        publish(recipient_key, message_id, attachment.data.json)
+
+
+async def check_quota(unpack_msg: UnpackResult):
+    """ Reason the forwarded messages don't fit in the recipient queue quotas, None if they fit """
+    if not (QUEUE_MAX_MESSAGES or QUEUE_MAX_BYTES or CONNECTION_MAX_MESSAGES or CONNECTION_MAX_BYTES):
+        return None
+    count = len(unpack_msg.message.attachments)
+    size = sum(len(json.dumps(attachment.data.json)) for attachment in unpack_msg.message.attachments)
+    queue, connection_queue = await get_queue_stats(unpack_msg.message.body["next"])
+    if QUEUE_MAX_MESSAGES and queue["count"] + count > QUEUE_MAX_MESSAGES:
+        return "Too many messages queued for the recipient"
+    if QUEUE_MAX_BYTES and queue["bytes"] + size > QUEUE_MAX_BYTES:
+        return "Too many bytes queued for the recipient"
+    if CONNECTION_MAX_MESSAGES and connection_queue["count"] + count > CONNECTION_MAX_MESSAGES:
+        return "Too many messages queued for the recipient connection"
+    if CONNECTION_MAX_BYTES and connection_queue["bytes"] + size > CONNECTION_MAX_BYTES:
+        return "Too many bytes queued for the recipient connection"
+    return None
+
+
+async def process_quota_exceeded(unpack_msg: UnpackResult, comment: str):
+    """ Report the full queue to the sender, anonymous senders only get the QuotaExceeded error """
+    print("Forward refused:", comment)
+    if not unpack_msg.metadata.encrypted_from:
+        raise QuotaExceeded(comment)
+    response_message = Message(
+        id=str(uuid.uuid4()),
+        pthid=unpack_msg.message.id if not unpack_msg.message.thid else unpack_msg.message.thid,
+        type="https://didcomm.org/report-problem/2.0/problem-report",
+        ack=unpack_msg.message.id,
+        body={
+                "code": "e.p.msg.quota-exceeded",
+                "comment": comment
+        }
+    )
+    return await pack_reply(
+        response_message,
+        frm=unpack_msg.metadata.encrypted_to[0].split("#")[0],
+        to=unpack_msg.metadata.encrypted_from.split("#")[0]
+    )
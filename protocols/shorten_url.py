@@ -1,22 +1,15 @@
 """ Shorten URL 1.0 Protocol """
 from didcomm.message import Message, FromPrior
 import uuid
-from didcomm.pack_encrypted import pack_encrypted, PackEncryptedConfig, PackEncryptedResult
-from didcomm.common.resolvers import ResolversConfig
+from didcomm_v2.pack_reply import pack_reply
 from didcomm.unpack import UnpackResult
 from importlib_metadata import metadata
-from didcomm_v2.peer_did import get_secret_resolver
-from didcomm_v2.peer_did import DIDResolverPeerDID
+from didcomm_v2.protocol_router import register
 from db_utils import store_short_url, expire_short_url
 import datetime
 import os
 
-async def process_shorten_url_message(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
-    if unpack_msg.message.type == "https://didcomm.org/shorten-url/1.0/request-shortened-url":
-        return await process_shortened_url_request(unpack_msg, remote_did, local_did, from_prior)
-    elif unpack_msg.message.type == "https://didcomm.org/shorten-url/1.0/invalidate-shortened-url":
-        return await process_invalidate(unpack_msg, remote_did, local_did, from_prior)
-
+@register("https://didcomm.org/shorten-url", "1.0", "request-shortened-url")
 async def process_shortened_url_request(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
     long_url = unpack_msg.message.body["url"]
     requested_validity_seconds = unpack_msg.message.body["requested_validity_seconds"]
@@ -28,7 +21,7 @@ async def process_shortened_url_request(unpack_msg: UnpackResult, remote_did, lo
         expires_time = int(date + requested_validity_seconds * 1000) if requested_validity_seconds > 0 else 0
         server_url = os.environ["PUBLIC_URL"] if "PUBLIC_URL" in os.environ  else "http://127.0.0.1:8000"
         short_url = server_url + "/qr" + short_url_slug + "?_oobid=" + oobid
-        store_short_url(
+        await store_short_url(
             {
                 "date": date,
                 "expires_time": expires_time,
@@ -49,27 +42,17 @@ async def process_shortened_url_request(unpack_msg: UnpackResult, remote_did, lo
             },
             from_prior = from_prior
         )
-        response_packed = await pack_encrypted(
-            resolvers_config=ResolversConfig(
-                secrets_resolver=get_secret_resolver(),
-                did_resolver=DIDResolverPeerDID()
-            ),
-            message=response_message,
-            frm=local_did,
-            to=remote_did,
-            sign_frm=None,
-            pack_config=PackEncryptedConfig(protect_sender_id=False)
-        )
-        return response_packed.packed_msg
+        return await pack_reply(response_message, local_did, remote_did)
     else:
         # TODO Report Problem
         return
 
+@register("https://didcomm.org/shorten-url", "1.0", "invalidate-shortened-url")
 async def process_invalidate(unpack_msg: UnpackResult, remote_did, local_did, from_prior: FromPrior):
     shortened_url = unpack_msg.message.body["shortened_url"]
     oobid = shortened_url.split("=")[1]
     print("obid",oobid)
-    expire_short_url(oobid)
+    await expire_short_url(oobid)
     response_message = Message(
         id=str(uuid.uuid4()),
         ack=unpack_msg.message.id,
@@ -77,15 +60,4 @@ async def process_invalidate(unpack_msg: UnpackResult, remote_did, local_did, fr
         body={},
         from_prior = from_prior
     )
-    response_packed = await pack_encrypted(
-        resolvers_config=ResolversConfig(
-            secrets_resolver=get_secret_resolver(),
-            did_resolver=DIDResolverPeerDID()
-        ),
-        message=response_message,
-        frm=local_did,
-        to=remote_did,
-        sign_frm=None,
-        pack_config=PackEncryptedConfig(protect_sender_id=False)
-    )
-    return response_packed.packed_msg
+    return await pack_reply(response_message, local_did, remote_did)
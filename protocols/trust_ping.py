@@ -1,16 +1,15 @@
 """ Trust Ping Protocol 2.0 """
 import uuid
 from didcomm.message import Message
-from didcomm.pack_encrypted import pack_encrypted, PackEncryptedConfig
+from didcomm_v2.pack_reply import pack_reply
 from didcomm.unpack import UnpackResult
-from didcomm.common.resolvers import ResolversConfig
-from didcomm_v2.peer_did import get_secret_resolver
-from didcomm_v2.peer_did import DIDResolverPeerDID
 from didcomm_v2.send_http_message import send_http_msg
+from didcomm_v2.protocol_router import register
 
 
 
-async def process_trust_ping(unpack_msg:UnpackResult):
+@register("https://didcomm.org/trust-ping", "2.0", "ping", requires_connection=False)
+async def process_trust_ping(unpack_msg:UnpackResult, remote_did=None, local_did=None, from_prior=None):
     """ Response to Trust Ping message """
     if unpack_msg.message.body["response_requested"]:
         response_message = Message(
@@ -19,16 +18,9 @@ async def process_trust_ping(unpack_msg:UnpackResult):
             type="https://didcomm.org/trust-ping/2.0/ping-response",
             body={}
         )
-        response_packed = await pack_encrypted(
-            resolvers_config=ResolversConfig(
-                secrets_resolver=get_secret_resolver(),
-                did_resolver=DIDResolverPeerDID()
-            ),
-            message=response_message,
-            frm=unpack_msg.metadata.encrypted_to[0].split("#")[0],
-            to=unpack_msg.metadata.encrypted_from.split("#")[0],
-            sign_frm=None,
-            pack_config=PackEncryptedConfig(protect_sender_id=False)
-        )
         # await send_http_msg(response_packed, unpack_msg.metadata.encrypted_from.split("#")[0], unpack_msg.metadata.encrypted_to[0].split("#")[0])
-        return response_packed.packed_msg
\ No newline at end of file
+        return await pack_reply(
+            response_message,
+            frm=unpack_msg.metadata.encrypted_to[0].split("#")[0],
+            to=unpack_msg.metadata.encrypted_from.split("#")[0]
+        )
\ No newline at end of file